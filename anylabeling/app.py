@@ -15,6 +15,7 @@ import sys
 import yaml
 from PyQt5 import QtCore, QtWidgets
 
+from anylabeling import batch
 from anylabeling.app_info import __appname__
 from anylabeling.config import get_config
 from anylabeling import config as anylabeling_config
@@ -24,6 +25,26 @@ from anylabeling.views.labeling.utils import new_icon
 from anylabeling.resources import resources
 
 
+class CommandAction(argparse._SubParsersAction):
+    """Commands of the application. A first positional argument which is
+    not a command is the file to open in the GUI, followed by options."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Any first positional argument is accepted, commands are
+        # looked up by name
+        self.choices = None
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        if values[0] in self._name_parser_map:
+            super().__call__(parser, namespace, values, option_string)
+            return
+        if namespace.filename is not None:
+            parser.error(f"unrecognized arguments: {' '.join(values)}")
+        namespace.filename = values[0]
+        parser.parse_args(values[1:], namespace)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -35,7 +56,22 @@ def main():
         choices=["debug", "info", "warning", "fatal", "error"],
         help="logger level",
     )
-    parser.add_argument("filename", nargs="?", help="image or label filename")
+    commands = parser.add_subparsers(
+        title="commands",
+        dest="command",
+        metavar="filename | command",
+        help="image or label filename, or a command:",
+        action=CommandAction,
+    )
+    batch.add_arguments(
+        commands.add_parser(
+            "batch",
+            help="auto label a folder of images without the GUI",
+            description="Auto label a folder of images without the GUI. "
+            "Options of anylabeling, such as --config, go before batch.",
+        )
+    )
+    parser.set_defaults(filename=None)
     parser.add_argument(
         "--output",
         "-O",
@@ -120,6 +156,9 @@ def main():
 
     logger.setLevel(getattr(logging, args.logger_level.upper()))
 
+    if args.command == "batch":
+        sys.exit(batch.run(args))
+
     if hasattr(args, "flags"):
         if os.path.isfile(args.flags):
             with codecs.open(args.flags, "r", encoding="utf-8") as f:
@@ -142,6 +181,7 @@ def main():
             args.label_flags = yaml.safe_load(args.label_flags)
 
     config_from_args = args.__dict__
+    config_from_args.pop("command")
     reset_config = config_from_args.pop("reset_config")
     filename = config_from_args.pop("filename")
     output = config_from_args.pop("output")
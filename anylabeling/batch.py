@@ -0,0 +1,259 @@
+"""Headless batch auto labeling of a folder of images.
+
+Usage:
+    anylabeling batch --model yolov8n-r20230415 images/ [--output labels/]
+
+The model is a name from models.yaml (or of a custom model) or the path
+of a model config.yaml. Label files are written like the GUI writes them:
+next to the images, or flat into the output directory. Images which
+already have a label file are skipped, and processed images are recorded
+in a checkpoint file, so an interrupted run resumes where it stopped.
+
+Options of anylabeling, such as --config or --nodata, go before "batch".
+"""
+import argparse
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import os.path as osp
+import time
+
+import yaml
+
+from anylabeling import config as anylabeling_config
+from anylabeling.config import get_config
+from anylabeling.services.auto_labeling.model_factory import create_model
+from anylabeling.views.labeling.label_file import LabelFile
+from anylabeling.views.labeling.logger import logger
+from anylabeling.views.labeling.project_index import (
+    get_image_extensions,
+    get_label_file,
+    list_images,
+)
+from anylabeling.views.labeling.utils.image_cache import decode_image
+
+CHECKPOINT_FILE_NAME = ".anylabeling_batch_checkpoint"
+
+# Model of a worker process
+_model = None
+
+
+def get_model_config(model):
+    """Get the config of a model from its name or config file,
+    downloading the model if needed"""
+    if osp.isfile(model):
+        with open(model, "r") as f:
+            model_config = yaml.safe_load(f)
+        model_config["config_file"] = osp.normpath(osp.abspath(model))
+        return model_config
+
+    from anylabeling.services.auto_labeling.model_manager import ModelManager
+
+    model_manager = ModelManager()
+    model_manager.new_model_status.connect(logger.info)
+    for model_config in model_manager.get_model_configs():
+        if model_config["name"] != model:
+            continue
+        if not model_config.get("has_downloaded", True):
+            downloaded_model_config = model_manager.download_and_extract_model(
+                model_config
+            )
+            if downloaded_model_config is None:
+                raise RuntimeError(f"Could not download model: {model}")
+            model_config.update(downloaded_model_config)
+        return model_config
+    raise ValueError(f"Unknown model: {model}")
+
+
+def format_shape(shape):
+    data = shape.other_data.copy()
+    data.update(
+        {
+            "label": shape.label,
+            "text": shape.text,
+            "points": [(p.x(), p.y()) for p in shape.points],
+            "group_id": shape.group_id,
+            "shape_type": shape.shape_type,
+            "flags": shape.flags,
+        }
+    )
+    return data
+
+
+def init_worker(config_file, model_config, output_mode):
+    """Load the model of a worker"""
+    global _model
+    anylabeling_config.current_config_file = config_file
+    _model = create_model(model_config, on_message=logger.info)
+    if output_mode:
+        _model.set_output_mode(output_mode)
+
+
+def label_image(image_file, label_file, store_data, compact):
+    """Run the model on an image and save its label file if any object
+    is found. Returns the number of found objects."""
+    # Decoded like the GUI decodes images
+    image = decode_image(image_file)
+    result = _model.predict_shapes(image, image_file)
+    shapes = [format_shape(shape) for shape in getattr(result, "shapes", [])]
+    if not shapes:
+        return 0
+
+    label_dir = osp.dirname(label_file)
+    if label_dir:
+        os.makedirs(label_dir, exist_ok=True)
+    LabelFile().save(
+        filename=label_file,
+        shapes=shapes,
+        image_path=osp.relpath(image_file, label_dir),
+        image_data=(
+            LabelFile.load_image_file(image_file) if store_data else None
+        ),
+        image_height=image.shape[0],
+        image_width=image.shape[1],
+        compact=compact,
+    )
+    return len(shapes)
+
+
+def run_jobs(jobs, num_workers, initargs):
+    """Run label_image() over jobs and yield (job, number of objects or
+    exception), in completion order"""
+    if not jobs:
+        return
+    if num_workers <= 1:
+        init_worker(*initargs)
+        for job in jobs:
+            try:
+                yield job, label_image(*job)
+            except Exception as e:  # noqa
+                yield job, e
+        return
+
+    # Spawned workers do not inherit threads of this process
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=initargs,
+    ) as executor:
+        # Keep a bounded number of jobs in flight, so that results are
+        # streamed and checkpointed while the run goes on
+        jobs = iter(jobs)
+        futures = {}
+        while True:
+            for job in jobs:
+                futures[executor.submit(label_image, *job)] = job
+                if len(futures) >= 2 * num_workers:
+                    break
+            if not futures:
+                return
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                job = futures.pop(future)
+                yield job, future.exception() or future.result()
+
+
+def add_arguments(parser):
+    """Add the arguments of the batch command to its parser. The config
+    file, logger level and --nodata are options of the main parser."""
+    parser.add_argument("input_dir", help="folder of images")
+    parser.add_argument(
+        "--model",
+        "-m",
+        required=True,
+        help="model name from models.yaml or path of a model config.yaml",
+    )
+    parser.add_argument(
+        "--output",
+        "-O",
+        "-o",
+        help="output directory (default: next to the images)",
+        default=argparse.SUPPRESS,
+    )
+    parser.add_argument(
+        "--output-mode",
+        help="model output mode, e.g. polygon, rectangle or everything",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes, each with its own model",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="label all images again, ignoring existing label files "
+        "and the checkpoint",
+    )
+
+
+def run(args):
+    """Run the batch command with the parsed arguments.
+    Returns the exit status."""
+    # Progress is reported through the logger
+    logging.basicConfig(format="%(asctime)s %(message)s")
+    anylabeling_config.current_config_file = args.config
+    config = get_config()
+    store_data = getattr(args, "store_data", config["store_data"])
+    model_config = get_model_config(args.model)
+
+    # Resume from the checkpoint of an interrupted run
+    output_dir = args.output or args.input_dir
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint_file = osp.join(output_dir, CHECKPOINT_FILE_NAME)
+    done_images = set()
+    if not args.overwrite and osp.isfile(checkpoint_file):
+        with open(checkpoint_file, "r", encoding="utf-8") as f:
+            done_images = {line.rstrip("\n") for line in f}
+
+    jobs = []
+    images = list_images(args.input_dir, get_image_extensions(), args.output)
+    for image_file, _, has_label_file in images:
+        image_file = osp.abspath(image_file)
+        if not args.overwrite and (
+            image_file in done_images or has_label_file
+        ):
+            continue
+        label_file = get_label_file(image_file, args.output)
+        jobs.append(
+            (image_file, label_file, store_data, config["compact_label_file"])
+        )
+    logger.info(
+        f"Labeling {len(jobs)} images with {model_config['display_name']}, "
+        f"skipping {len(images) - len(jobs)} already labeled images"
+    )
+
+    num_failed = 0
+    start_time = time.time()
+    with open(
+        checkpoint_file, "w" if args.overwrite else "a", encoding="utf-8"
+    ) as checkpoint:
+        initargs = (args.config, model_config, args.output_mode)
+        results = run_jobs(jobs, args.workers, initargs)
+        for i, ((image_file, *_), result) in enumerate(results, 1):
+            if isinstance(result, Exception):
+                num_failed += 1
+                status = f"failed: {result}"
+            else:
+                checkpoint.write(image_file + "\n")
+                checkpoint.flush()
+                status = f"{result} objects"
+            elapsed_time = time.time() - start_time
+            throughput = i / elapsed_time if elapsed_time > 0 else 0.0
+            remaining_time = (len(jobs) - i) / throughput if throughput else 0
+            logger.info(
+                f"[{i}/{len(jobs)}] {image_file}: {status} "
+                f"({throughput:.2f} images/s, "
+                f"{remaining_time:.0f}s remaining)"
+            )
+
+    logger.info(
+        f"Done: {len(jobs) - num_failed} images labeled, {num_failed} "
+        f"failed, in {time.time() - start_time:.1f}s"
+    )
+    return 1 if num_failed else 0
@@ -0,0 +1,152 @@
+"""Automatic mask generation ("segment everything") for Segment Anything.
+
+A grid of point prompts is decoded against one image embedding. Masks are
+filtered by predicted IoU and stability score, then de-duplicated with a
+mask NMS. All filtering runs on low resolution decoder outputs, only the
+kept objects are decoded again and upscaled around their region.
+"""
+import numpy as np
+
+# Longest side of the masks used for filtering and NMS
+WORKING_SIZE = 256
+
+
+def build_point_grid(points_per_side, image_size):
+    """Build a grid of points evenly spread over an image,
+    in (x, y) pixel coordinates. image_size is (height, width)."""
+    offset = 1 / (2 * points_per_side)
+    points_one_side = np.linspace(offset, 1 - offset, points_per_side)
+    points_x = np.tile(points_one_side[None, :], (points_per_side, 1))
+    points_y = np.tile(points_one_side[:, None], (1, points_per_side))
+    points = np.stack([points_x, points_y], axis=-1).reshape(-1, 2)
+    return points * np.array([image_size[1], image_size[0]])
+
+
+def calculate_stability_score(mask_logits, mask_threshold, threshold_offset):
+    """Compute the stability score of a batch of masks: the IoU between
+    the binary masks obtained by thresholding the logits at
+    mask_threshold +/- threshold_offset."""
+    intersections = np.count_nonzero(
+        mask_logits > (mask_threshold + threshold_offset), axis=(-1, -2)
+    )
+    unions = np.count_nonzero(
+        mask_logits > (mask_threshold - threshold_offset), axis=(-1, -2)
+    )
+    return intersections / np.maximum(unions, 1)
+
+
+def mask_nms(masks, scores, iou_threshold):
+    """Greedy non maximum suppression on binary masks.
+    Returns the indices of kept masks, sorted by decreasing score."""
+    order = np.argsort(-scores, kind="stable")
+    flat_masks = masks[order].reshape(len(order), -1).astype(np.float32)
+    areas = flat_masks.sum(axis=1)
+    intersections = flat_masks @ flat_masks.T
+    ious = intersections / np.maximum(
+        areas[:, None] + areas[None, :] - intersections, 1
+    )
+
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= ious[i] > iou_threshold
+    return order[keep]
+
+
+class AutomaticMaskGenerator:
+    """Generate masks for all objects of an image from a grid of points"""
+
+    def __init__(
+        self,
+        model,
+        points_per_side=32,
+        points_per_batch=64,
+        pred_iou_thresh=0.88,
+        stability_score_thresh=0.95,
+        stability_score_offset=1.0,
+        mask_threshold=0.0,
+        nms_thresh=0.7,
+        output_batch_size=8,
+    ):
+        """Initialize the generator
+
+        Args:
+            model: SegmentAnythingONNX or SegmentAnything2ONNX model.
+            points_per_side (int): Number of grid points along each side.
+            points_per_batch (int): Number of points decoded per run.
+                Decoders exported with a batch size of 1, like most
+                Segment Anything (SAM1) exports, fall back to one run
+                per point, i.e. points_per_side ** 2 runs.
+            pred_iou_thresh (float): Min predicted mask quality.
+            stability_score_thresh (float): Min mask stability score.
+            stability_score_offset (float): Logit offset used to
+                compute the stability score.
+            mask_threshold (float): Logit threshold of the masks.
+            nms_thresh (float): Max IoU between two kept masks.
+            output_batch_size (int): Number of full size masks
+                decoded at the same time for the kept objects.
+        """
+        self.model = model
+        self.points_per_side = points_per_side
+        self.points_per_batch = points_per_batch
+        self.pred_iou_thresh = pred_iou_thresh
+        self.stability_score_thresh = stability_score_thresh
+        self.stability_score_offset = stability_score_offset
+        self.mask_threshold = mask_threshold
+        self.nms_thresh = nms_thresh
+        self.output_batch_size = output_batch_size
+
+    @staticmethod
+    def point_prompt(point):
+        return [{"type": "point", "data": point.tolist(), "label": 1}]
+
+    def generate(self, embedding):
+        """Generate masks for an image embedding. Yields, for every
+        object, mask logits of its region in the original image and
+        the (x, y) offset of this region."""
+        points = build_point_grid(
+            self.points_per_side, embedding["original_size"]
+        )
+
+        kept_points = []
+        kept_masks = []
+        kept_scores = []
+        for start in range(0, len(points), self.points_per_batch):
+            batch_points = points[start : start + self.points_per_batch]
+            mask_logits, iou_preds = self.model.predict_low_res_masks_batch(
+                embedding,
+                [self.point_prompt(point) for point in batch_points],
+            )
+
+            # Downsample to the working size to bound memory use of NMS
+            stride = max(1, max(mask_logits.shape[1:]) // WORKING_SIZE)
+            mask_logits = mask_logits[:, ::stride, ::stride]
+
+            stability_scores = calculate_stability_score(
+                mask_logits, self.mask_threshold, self.stability_score_offset
+            )
+            keep = (iou_preds > self.pred_iou_thresh) & (
+                stability_scores >= self.stability_score_thresh
+            )
+            keep &= np.any(mask_logits > self.mask_threshold, axis=(1, 2))
+            kept_points.append(batch_points[keep])
+            kept_masks.append(mask_logits[keep] > self.mask_threshold)
+            kept_scores.append(iou_preds[keep])
+
+        points = np.concatenate(kept_points)
+        masks = np.concatenate(kept_masks)
+        scores = np.concatenate(kept_scores)
+        if len(points) == 0:
+            return
+        points = points[mask_nms(masks, scores, self.nms_thresh)]
+
+        # Decode kept objects at full size, a few at a time
+        for start in range(0, len(points), self.output_batch_size):
+            batch_points = points[start : start + self.output_batch_size]
+            yield from self.model.predict_mask_rois(
+                embedding,
+                [self.point_prompt(point) for point in batch_points],
+            )
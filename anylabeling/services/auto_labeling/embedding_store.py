@@ -0,0 +1,240 @@
+"""Persistent on-disk store for image embeddings.
+
+Embeddings are saved as one folder per image, with every numpy array in a
+separate ``.npy`` file so that it can be memory-mapped back on load.
+Entries are keyed by the image content hash and live in a namespace made
+of the model name and a fingerprint of the encoder file, so a different
+encoder never reuses stale embeddings.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_EMBEDDING_STORE_DIR = os.path.join(
+    os.path.expanduser("~"), "anylabeling_data", "embedding_cache"
+)
+DEFAULT_EMBEDDING_STORE_QUOTA_MB = 4096
+
+META_FILE = "meta.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+FINGERPRINT_SAMPLE_SIZE = 4 * 1024 * 1024
+
+
+def hash_file(filename):
+    """Return the SHA-1 hex digest of a file content"""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def fingerprint_file(filename):
+    """Return a cheap fingerprint of a (possibly very large) model file.
+    Hash the file size, the head and the tail of the file instead of
+    reading gigabytes of weights on every model load.
+    """
+    sha1 = hashlib.sha1()
+    file_size = os.path.getsize(filename)
+    sha1.update(str(file_size).encode("utf-8"))
+    with open(filename, "rb") as f:
+        sha1.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+        if file_size > FINGERPRINT_SAMPLE_SIZE:
+            f.seek(
+                max(
+                    FINGERPRINT_SAMPLE_SIZE,
+                    file_size - FINGERPRINT_SAMPLE_SIZE,
+                )
+            )
+            sha1.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+    return sha1.hexdigest()
+
+
+class EmbeddingStore:
+    """Thread-safe, size-limited on-disk LRU store for image embeddings.
+
+    Values are dicts of numpy arrays and small JSON-serializable items
+    (e.g. ``original_size``). Arrays are returned memory-mapped.
+    """
+
+    def __init__(self, namespace, cache_dir=None, max_size_mb=None):
+        if cache_dir is None:
+            cache_dir = DEFAULT_EMBEDDING_STORE_DIR
+        if max_size_mb is None:
+            max_size_mb = DEFAULT_EMBEDDING_STORE_QUOTA_MB
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+
+        # Index of all entries of the store (all namespaces share the quota)
+        # entry path -> [size in bytes, last access time]
+        self._entries = None
+        self._total_size = 0
+
+        # Content hashes of images, keyed by (path, size, mtime)
+        self._image_hashes = {}
+
+    @staticmethod
+    def get_namespace(model_name, encoder_model_path):
+        """Build the namespace of a model from its name and encoder file"""
+        return "{}-{}".format(
+            model_name, fingerprint_file(encoder_model_path)[:16]
+        )
+
+    def get_image_hash(self, filename):
+        """Return the content hash of an image, computed once per version
+        of the file"""
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            image_hash = self._image_hashes.get(key)
+        if image_hash is None:
+            image_hash = hash_file(filename)
+            with self.lock:
+                self._image_hashes[key] = image_hash
+        return image_hash
+
+    def _entry_path(self, image_hash):
+        return os.path.join(self.cache_dir, self.namespace, image_hash)
+
+    @staticmethod
+    def _folder_size(path):
+        return sum(
+            entry.stat().st_size
+            for entry in os.scandir(path)
+            if entry.is_file()
+        )
+
+    def _load_index(self):
+        """Scan the store folder to build the LRU index. Lock must be held."""
+        if self._entries is not None:
+            return
+        self._entries = {}
+        self._total_size = 0
+        if not os.path.isdir(self.cache_dir):
+            return
+        for namespace in os.scandir(self.cache_dir):
+            if not namespace.is_dir():
+                continue
+            for entry in os.scandir(namespace.path):
+                if not entry.is_dir() or entry.name.startswith("."):
+                    continue
+                try:
+                    size = self._folder_size(entry.path)
+                    last_access = entry.stat().st_mtime
+                except OSError:
+                    continue
+                self._entries[entry.path] = [size, last_access]
+                self._total_size += size
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries, except the entry of path
+        keep, until the store fits its quota. Lock must be held."""
+        if self._total_size <= self.max_size:
+            return
+        for path, (size, _) in sorted(
+            self._entries.items(), key=lambda item: item[1][1]
+        ):
+            if self._total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            del self._entries[path]
+            self._total_size -= size
+
+    def get(self, filename):
+        """Get embedding of an image file. Returns None if not present."""
+        try:
+            path = self._entry_path(self.get_image_hash(filename))
+            with open(os.path.join(path, META_FILE), "r") as f:
+                meta = json.load(f)
+            embedding = {
+                name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+                for name in meta["arrays"]
+            }
+        except (OSError, ValueError, KeyError):
+            return None
+        for name, value in meta["values"].items():
+            embedding[name] = (
+                tuple(value) if isinstance(value, list) else value
+            )
+
+        # Mark as recently used
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        with self.lock:
+            if self._entries is not None and path in self._entries:
+                self._entries[path][1] = now
+        return embedding
+
+    def put(self, filename, embedding):
+        """Save embedding of an image file. If the store is over its quota,
+        least recently used entries are evicted."""
+        if self.max_size <= 0:
+            return
+        try:
+            path = self._entry_path(self.get_image_hash(filename))
+            if os.path.isfile(os.path.join(path, META_FILE)):
+                return
+            namespace_dir = os.path.dirname(path)
+            os.makedirs(namespace_dir, exist_ok=True)
+
+            # Write to a temporary folder first, then move it into place
+            # so that readers never see a partially written entry
+            tmp_path = tempfile.mkdtemp(prefix=".", dir=namespace_dir)
+            meta = {"arrays": [], "values": {}}
+            for name, value in embedding.items():
+                if isinstance(value, np.ndarray):
+                    np.save(os.path.join(tmp_path, name + ".npy"), value)
+                    meta["arrays"].append(name)
+                else:
+                    meta["values"][name] = (
+                        list(value) if isinstance(value, tuple) else value
+                    )
+            with open(os.path.join(tmp_path, META_FILE), "w") as f:
+                json.dump(meta, f)
+            size = self._folder_size(tmp_path)
+            if os.path.isdir(path) and not os.path.isfile(
+                os.path.join(path, META_FILE)
+            ):
+                # Stale entry, e.g. left by a partly failed eviction
+                shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another thread has just saved the same entry
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning("Could not save embedding of %s: %s", filename, e)
+            return
+
+        with self.lock:
+            self._load_index()
+            # The index may hold the size of a replaced stale entry
+            old_size = self._entries.get(path, [0])[0]
+            self._entries[path] = [size, time.time()]
+            self._total_size += size - old_size
+            # The new entry is kept even if it is alone over the quota
+            self._evict(keep=path)
+
+    def find(self, filename):
+        """Returns True if embedding of an image file is in the store,
+        False otherwise."""
+        try:
+            path = self._entry_path(self.get_image_hash(filename))
+        except OSError:
+            return False
+        return os.path.isfile(os.path.join(path, META_FILE))
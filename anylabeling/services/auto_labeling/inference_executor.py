@@ -0,0 +1,126 @@
+"""Long-lived worker threads for model inference, organized in lanes."""
+from concurrent.futures import Future
+import heapq
+import itertools
+import threading
+
+# Lanes of the executor owned by ModelManager
+LANE_INTERACTIVE = "interactive"
+LANE_PRELOAD = "preload"
+LANE_LOADING = "loading"
+
+
+class InferenceExecutor:
+    """Run jobs on long-lived worker threads, one thread per lane.
+
+    Jobs are submitted to a lane and return a `concurrent.futures.Future`.
+    Jobs of a lane run one at a time, by increasing priority value, then
+    in submission order. Pending jobs are cancelled with `Future.cancel()`
+    or `cancel_pending()`. A lane can yield to other lanes: it does not
+    start a job while any of them has a running or pending job, so
+    background work never competes with interactive work.
+    """
+
+    class _Lane:
+        def __init__(self, name, yield_to):
+            self.name = name
+            self.yield_to = yield_to
+            self.queue = []
+            self.running = False
+            self.thread = None
+
+    def __init__(self, lanes, yield_to=None):
+        """Initialize the executor
+
+        Args:
+            lanes (list): Names of the lanes.
+            yield_to (dict, optional): Lane name -> names of the lanes
+                it yields to.
+        """
+        yield_to = yield_to or {}
+        self._condition = threading.Condition()
+        self._counter = itertools.count()
+        self._shutdown = False
+        self._lanes = {
+            name: self._Lane(name, yield_to.get(name, [])) for name in lanes
+        }
+        for lane in self._lanes.values():
+            lane.thread = threading.Thread(
+                target=self._run, args=(lane,), name=f"Inference-{lane.name}"
+            )
+            lane.thread.daemon = True
+            lane.thread.start()
+
+    def submit(self, lane, func, *args, priority=0, **kwargs):
+        """Submit func(*args, **kwargs) to a lane and return its future"""
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit jobs after shutdown")
+            heapq.heappush(
+                self._lanes[lane].queue,
+                (priority, next(self._counter), future, func, args, kwargs),
+            )
+            self._condition.notify_all()
+        return future
+
+    def cancel_pending(self, lane):
+        """Cancel all pending jobs of a lane"""
+        with self._condition:
+            jobs = self._lanes[lane].queue
+            self._lanes[lane].queue = []
+        for job in jobs:
+            job[2].cancel()
+
+    def is_idle(self, lane):
+        """Returns True if a lane has no running or pending job"""
+        with self._condition:
+            return self._is_idle(self._lanes[lane])
+
+    def shutdown(self, wait=False):
+        """Cancel pending jobs and stop worker threads after their
+        running job"""
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        for lane in self._lanes:
+            self.cancel_pending(lane)
+        if wait:
+            for lane in self._lanes.values():
+                lane.thread.join()
+
+    @staticmethod
+    def _is_idle(lane):
+        # Cancelled jobs stay in the queue until the worker pops them
+        return not lane.running and all(
+            job[2].cancelled() for job in lane.queue
+        )
+
+    def _must_yield(self, lane):
+        return not all(
+            self._is_idle(self._lanes[name]) for name in lane.yield_to
+        )
+
+    def _run(self, lane):
+        while True:
+            with self._condition:
+                while not self._shutdown and (
+                    not lane.queue or self._must_yield(lane)
+                ):
+                    self._condition.wait()
+                if self._shutdown:
+                    return
+                _, _, future, func, args, kwargs = heapq.heappop(lane.queue)
+                if not future.set_running_or_notify_cancel():
+                    self._condition.notify_all()
+                    continue
+                lane.running = True
+
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._condition:
+                    lane.running = False
+                    self._condition.notify_all()
@@ -2,32 +2,217 @@
 from collections import OrderedDict
 import threading
 
+import numpy as np
+
+
+def get_nbytes(value):
+    """Get the size in bytes of the numpy payloads in a value.
+    Dicts, lists and tuples are walked recursively, other objects
+    are not counted."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(get_nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(get_nbytes(item) for item in value)
+    return 0
+
+
+class SingleFlight:
+    """Deduplicate concurrent computations of the same key.
+
+    The first caller of `do()` for a key runs the function, other callers
+    for the same key wait for it and get its result (or its exception)
+    instead of running the function again.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Run func(*args, **kwargs) once for all concurrent callers
+        with the same key and return its result"""
+        with self.lock:
+            call = self._calls.get(key)
+            is_owner = call is None
+            if is_owner:
+                call = self._Call()
+                self._calls[key] = call
+
+        if not is_owner:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def do_many(self, keys, func):
+        """Run func(owned_keys) for the keys which are not already in
+        flight. func must return a list of results in the order of
+        owned_keys. Concurrent callers of `do()` for any owned key wait
+        for this call. Returns a dict of results for the owned keys."""
+        with self.lock:
+            owned_keys = []
+            for key in keys:
+                if key not in self._calls and key not in owned_keys:
+                    self._calls[key] = self._Call()
+                    owned_keys.append(key)
+            calls = [self._calls[key] for key in owned_keys]
+        if not owned_keys:
+            return {}
+
+        try:
+            results = func(owned_keys)
+            for call, result in zip(calls, results):
+                call.result = result
+        except BaseException as e:
+            for call in calls:
+                call.error = e
+            raise
+        finally:
+            with self.lock:
+                for key in owned_keys:
+                    del self._calls[key]
+            for call in calls:
+                call.event.set()
+        return dict(zip(owned_keys, results))
+
+    def in_flight(self, key):
+        """Returns True if a computation for key is running"""
+        with self.lock:
+            return key in self._calls
+
 
 class LRUCache:
-    """Thread-safe LRU cache implementation."""
+    """Thread-safe LRU cache implementation.
+
+    Items are evicted when the cache holds more than `maxsize` entries or,
+    if `max_bytes` is set, when the numpy payloads of the cached values
+    take more than `max_bytes`. The most recent item is always kept.
+    """
 
-    def __init__(self, maxsize=10):
+    def __init__(self, maxsize=10, max_bytes=None):
         self.maxsize = maxsize
+        self.max_bytes = max_bytes
         self.lock = threading.Lock()
         self._cache = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._flights = SingleFlight()
 
     def get(self, key):
         """Get value from cache. Returns None if key is not present."""
         with self.lock:
             if key not in self._cache:
+                self.misses += 1
                 return None
+            self.hits += 1
             self._cache.move_to_end(key)
             return self._cache[key]
 
     def put(self, key, value):
-        """Put value into cache. If cache is full, oldest item is evicted."""
+        """Put value into cache. If cache is full, oldest items are evicted."""
+        nbytes = get_nbytes(value)
         with self.lock:
+            self.nbytes += nbytes - self._sizes.get(key, 0)
+            self._sizes[key] = nbytes
             self._cache[key] = value
             self._cache.move_to_end(key)
-            if len(self._cache) > self.maxsize:
-                self._cache.popitem(last=False)
+            while len(self._cache) > 1 and self._is_full():
+                oldest_key, _ = self._cache.popitem(last=False)
+                self.nbytes -= self._sizes.pop(oldest_key)
+                self.evictions += 1
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """Get value from cache. On a miss, compute it with
+        func(*args, **kwargs) and put it into cache. Concurrent calls for
+        the same key wait for a single computation. None results are
+        not cached."""
+        value = self.get(key)
+        if value is not None:
+            return value
+        return self._flights.do(
+            key, self._compute_and_put, key, func, args, kwargs
+        )
+
+    def _compute_and_put(self, key, func, args, kwargs):
+        # The value may have been put while this call was waiting
+        with self.lock:
+            value = self._cache.get(key)
+        if value is not None:
+            return value
+        value = func(*args, **kwargs)
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def compute_many(self, keys, func):
+        """Compute values of the keys which are neither cached nor being
+        computed with func(missing_keys), a function returning a list of
+        values in the order of missing_keys, and put them into cache.
+        Concurrent `get_or_compute()` calls for these keys wait for this
+        computation."""
+        with self.lock:
+            keys = [key for key in keys if key not in self._cache]
+        return self._flights.do_many(
+            keys,
+            lambda missing_keys: self._compute_and_put_many(
+                missing_keys, func
+            ),
+        )
+
+    def _compute_and_put_many(self, keys, func):
+        values = func(keys)
+        for key, value in zip(keys, values):
+            if value is not None:
+                self.put(key, value)
+        return values
+
+    def _is_full(self):
+        if self.maxsize is not None and len(self._cache) > self.maxsize:
+            return True
+        return self.max_bytes is not None and self.nbytes > self.max_bytes
 
     def find(self, key):
         """Returns True if key is in cache, False otherwise."""
         with self.lock:
             return key in self._cache
+
+    def average_nbytes(self):
+        """Returns the average size in bytes of cached items,
+        or 0 if the cache is empty."""
+        with self.lock:
+            if not self._cache:
+                return 0
+            return self.nbytes / len(self._cache)
+
+    def stats(self):
+        """Returns cache statistics"""
+        with self.lock:
+            return {
+                "size": len(self._cache),
+                "nbytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
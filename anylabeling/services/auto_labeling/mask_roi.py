@@ -0,0 +1,83 @@
+"""Upscale low resolution masks only around the objects they contain.
+
+Warping a decoder mask to the full size of a very large image allocates a
+float32 array of the whole image for every object. The functions below
+find the bounding region of the object at low resolution and warp only
+that region, returning the crop and its offset in the full image.
+"""
+import cv2
+import numpy as np
+
+
+def get_resize_matrix(input_size, output_size):
+    """Get the 3x3 matrix mapping pixel coordinates of an image of
+    input_size to an image of output_size, with the pixel center
+    convention of cv2.resize. Sizes are (height, width)."""
+    scale_x = output_size[1] / input_size[1]
+    scale_y = output_size[0] / input_size[0]
+    return np.array(
+        [
+            [scale_x, 0, 0.5 * scale_x - 0.5],
+            [0, scale_y, 0.5 * scale_y - 0.5],
+            [0, 0, 1],
+        ]
+    )
+
+
+def warp_mask_roi(
+    mask,
+    transform_matrix,
+    output_size,
+    threshold=0.0,
+    border_mode=cv2.BORDER_CONSTANT,
+):
+    """Warp the region of a mask around its foreground (values above
+    threshold) with bilinear interpolation.
+
+    Args:
+        mask (np.ndarray): Low resolution mask logits.
+        transform_matrix (np.ndarray): 3x3 matrix from mask coordinates
+            to output image coordinates.
+        output_size (tuple): Output image size (height, width).
+        threshold (float, optional): Mask threshold.
+        border_mode (int, optional): OpenCV border mode.
+
+    Returns:
+        tuple: The warped crop and its (x, y) offset in the output image.
+            The crop is empty if the mask has no foreground.
+    """
+    empty = np.zeros((0, 0), dtype=mask.dtype), (0, 0)
+    foreground = mask > threshold
+    rows = np.flatnonzero(foreground.any(axis=1))
+    if len(rows) == 0:
+        return empty
+    cols = np.flatnonzero(foreground.any(axis=0))
+
+    # Bilinear interpolation reads the neighbors of foreground pixels
+    corners = np.array(
+        [
+            [cols[0] - 1, rows[0] - 1, 1],
+            [cols[-1] + 1, rows[-1] + 1, 1],
+        ],
+        dtype=np.float64,
+    )
+    corners = corners @ transform_matrix[:2].T
+    x_min, y_min = np.floor(corners.min(axis=0)).astype(int)
+    x_max, y_max = np.ceil(corners.max(axis=0)).astype(int)
+    x_min, y_min = max(x_min, 0), max(y_min, 0)
+    x_max = min(x_max + 1, output_size[1])
+    y_max = min(y_max + 1, output_size[0])
+    if x_max <= x_min or y_max <= y_min:
+        return empty
+
+    # Shift the transformation so that the crop starts at (0, 0)
+    matrix = np.array(transform_matrix[:2], dtype=np.float64)
+    matrix[:, 2] -= (x_min, y_min)
+    crop = cv2.warpAffine(
+        mask,
+        matrix,
+        (int(x_max - x_min), int(y_max - y_min)),
+        flags=cv2.INTER_LINEAR,
+        borderMode=border_mode,
+    )
+    return crop, (int(x_min), int(y_min))
@@ -22,10 +22,11 @@ from abc import abstractmethod
 
 
 from PyQt5.QtCore import QFile, QObject
-from PyQt5.QtGui import QImage
 
 from .types import AutoLabelingResult
+from anylabeling.config import get_config
 from anylabeling.views.labeling.label_file import LabelFile, LabelFileError
+from anylabeling.views.labeling.utils.image_cache import get_image_cache
 
 
 class Model(QObject):
@@ -108,6 +109,20 @@ class Model(QObject):
             if name not in config:
                 raise Exception(f"Missing config: {name}")
 
+    def get_session_options(self, *config_names):
+        """
+        Get ONNX Runtime session options: the "onnxruntime" section of
+        the global config, overridden by "session_options" and then
+        by the given sections (e.g. "encoder_session_options")
+        of the model config
+        """
+        options = dict(get_config().get("onnxruntime") or {})
+        for name in ("session_options",) + config_names:
+            options.update(self.config.get(name) or {})
+        return {
+            key: value for key, value in options.items() if value is not None
+        }
+
     @abstractmethod
     def predict_shapes(self, image, filename=None) -> AutoLabelingResult:
         """
@@ -122,21 +137,49 @@ class Model(QObject):
         """
         raise NotImplementedError
 
+    def deactivate(self):
+        """
+        Stop background work when another model is selected.
+        The model stays in memory and can be selected again.
+        """
+        pass
+
+    def get_memory_usage(self):
+        """
+        Estimate memory usage of the model in bytes,
+        from the size of its model files
+        """
+        memory_usage = 0
+        for name, value in self.config.items():
+            if not name.endswith("model_path") or not isinstance(value, str):
+                continue
+            model_abs_path = self.get_model_abs_path(self.config, name)
+            if model_abs_path and os.path.isfile(model_abs_path):
+                memory_usage += os.path.getsize(model_abs_path)
+        return memory_usage
+
     @staticmethod
     def load_image_from_filename(filename):
-        """Load image from labeling file and return image data and image path."""
+        """Load the RGB image of a file, from the image embedded in its
+        label file if any, through the decoded image cache"""
         label_file = os.path.splitext(filename)[0] + ".json"
         if QFile.exists(label_file) and LabelFile.is_label_file(label_file):
             try:
-                label_file = LabelFile(label_file)
+                label = LabelFile(label_file)
+                if label.has_embedded_image:
+                    image = get_image_cache().get_from_data(label.image_data)
+                else:
+                    image = get_image_cache().get(
+                        os.path.join(
+                            os.path.dirname(label_file), label.image_path
+                        )
+                    )
             except LabelFileError as e:
                 logging.error("Error reading {}: {}".format(label_file, e))
-                return None, None
-            image_data = label_file.image_data
+                return None
         else:
-            image_data = LabelFile.load_image_file(filename)
-        image = QImage.fromData(image_data)
-        if image.isNull():
+            image = get_image_cache().get(filename)
+        if image is None:
             logging.error("Error reading {}".format(filename))
         return image
 
@@ -0,0 +1,31 @@
+"""Create auto labeling models from model configs."""
+
+MODEL_TYPES = ["segment_anything", "yolov5", "yolov8"]
+
+
+def create_model(model_config, on_message, executor=None):
+    """Create the model of a model config. Model modules are imported
+    on demand, so that only the dependencies of the used model are loaded.
+
+    Args:
+        model_config (dict): Model config, with its "config_file".
+        on_message (Callable): Called with status messages of the model.
+        executor (InferenceExecutor, optional): Executor of background
+            jobs of Segment Anything. If None, the model runs its own.
+    """
+    model_type = model_config.get("type")
+    if model_type == "yolov5":
+        from .yolov5 import YOLOv5
+
+        return YOLOv5(model_config, on_message=on_message)
+    if model_type == "yolov8":
+        from .yolov8 import YOLOv8
+
+        return YOLOv8(model_config, on_message=on_message)
+    if model_type == "segment_anything":
+        from .segment_anything import SegmentAnything
+
+        return SegmentAnything(
+            model_config, on_message=on_message, executor=executor
+        )
+    raise ValueError(f"Unknown model type: {model_type}")
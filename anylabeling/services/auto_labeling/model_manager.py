@@ -7,16 +7,26 @@ import logging
 import tempfile
 import zipfile
 import importlib.resources as pkg_resources
+from collections import OrderedDict
 from threading import Lock
 import urllib.request
 
 import yaml
-from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
 from PyQt5.QtCore import QCoreApplication
 
 from anylabeling.configs import auto_labeling as auto_labeling_configs
+from anylabeling.services.auto_labeling.inference_executor import (
+    InferenceExecutor,
+    LANE_INTERACTIVE,
+    LANE_LOADING,
+    LANE_PRELOAD,
+)
+from anylabeling.services.auto_labeling.model_factory import (
+    MODEL_TYPES,
+    create_model,
+)
 from anylabeling.services.auto_labeling.types import AutoLabelingResult
-from anylabeling.utils import GenericWorker
 
 from anylabeling.config import get_config, save_config
 
@@ -31,6 +41,7 @@ class ModelManager(QObject):
     """Model manager"""
 
     MAX_NUM_CUSTOM_MODELS = 5
+    DEFAULT_RESIDENT_MODELS_MEMORY_MB = 4096
 
     model_configs_changed = pyqtSignal(list)
     new_model_status = pyqtSignal(str)
@@ -43,6 +54,10 @@ class ModelManager(QObject):
     request_next_files_requested = pyqtSignal()
     output_modes_changed = pyqtSignal(dict, str)
 
+    # Emitted from worker threads, handled in the thread of the manager
+    model_loading_finished = pyqtSignal()
+    model_execution_finished = pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self.model_configs = []
@@ -50,11 +65,32 @@ class ModelManager(QObject):
         self.loaded_model_config = None
         self.loaded_model_config_lock = Lock()
 
-        self.model_download_worker = None
-        self.model_download_thread = None
-        self.model_execution_thread = None
-        self.model_execution_worker = None
-        self.model_execution_thread_lock = Lock()
+        # Loaded models kept in memory for fast switching, by config file,
+        # from least to most recently used
+        self.resident_models = OrderedDict()
+        self.resident_models_lock = Lock()
+        self.resident_models_memory_mb = get_config().get(
+            "resident_models_memory_mb",
+            self.DEFAULT_RESIDENT_MODELS_MEMORY_MB,
+        )
+
+        # Long-lived workers: interactive inference, background
+        # pre-encoding (only when no interactive job is waiting)
+        # and model loading
+        self.executor = InferenceExecutor(
+            [LANE_INTERACTIVE, LANE_PRELOAD, LANE_LOADING],
+            yield_to={LANE_PRELOAD: [LANE_INTERACTIVE]},
+        )
+        self.model_loading_future = None
+        self.model_loading_finished.connect(self.on_model_download_finished)
+        self.model_execution_finished.connect(self.on_model_execution_finished)
+        self.model_execution_lock = Lock()
+
+        # Prediction requests are coalesced: while a request is running,
+        # only the latest new request is kept pending
+        self.model_execution_busy = False
+        self.prediction_request_id = 0
+        self.pending_prediction_request = None
 
         self.load_model_configs()
 
@@ -162,8 +198,8 @@ class ModelManager(QObject):
         """Run custom model loading in a thread"""
         config_file = os.path.normpath(os.path.abspath(config_file))
         if (
-            self.model_download_thread is not None
-            and self.model_download_thread.isRunning()
+            self.model_loading_future is not None
+            and not self.model_loading_future.done()
         ):
             print(
                 "Another model is being loaded. Please wait for it to finish."
@@ -191,8 +227,7 @@ class ModelManager(QObject):
             "type" not in model_config
             or "display_name" not in model_config
             or "name" not in model_config
-            or model_config["type"]
-            not in ["segment_anything", "yolov5", "yolov8"]
+            or model_config["type"] not in MODEL_TYPES
         ):
             self.new_model_status.emit(
                 self.tr(
@@ -236,27 +271,21 @@ class ModelManager(QObject):
         # Reload model configs
         self.load_model_configs()
 
-        # Load model
-        self.load_model(model_config["config_file"])
+        # Load model, without reusing a resident model with an old config
+        self.load_model(model_config["config_file"], reload=True)
 
-    def load_model(self, config_file):
-        """Run model loading in a thread"""
+    def load_model(self, config_file, reload=False):
+        """Run model loading in a thread. Resident models are reused,
+        unless reload is True."""
         if (
-            self.model_download_thread is not None
-            and self.model_download_thread.isRunning()
+            self.model_loading_future is not None
+            and not self.model_loading_future.done()
         ):
             print(
                 "Another model is being loaded. Please wait for it to finish."
             )
             return
         if not config_file:
-            if self.model_download_worker is not None:
-                try:
-                    self.model_download_worker.finished.disconnect(
-                        self.on_model_download_finished
-                    )
-                except TypeError:
-                    pass
             self.unload_model()
             self.new_model_status.emit(self.tr("No model selected."))
             return
@@ -273,26 +302,19 @@ class ModelManager(QObject):
             )
             return
 
-        self.model_download_thread = QThread()
         self.new_model_status.emit(
             self.tr("Loading model: {model_name}. Please wait...").format(
                 model_name=self.model_configs[model_id]["display_name"]
             )
         )
-        self.model_download_worker = GenericWorker(self._load_model, model_id)
-        self.model_download_worker.finished.connect(
-            self.on_model_download_finished
+        self.model_loading_future = self.executor.submit(
+            LANE_LOADING, self._load_model, model_id, reload
         )
-        self.model_download_worker.finished.connect(
-            self.model_download_thread.quit
+        self.model_loading_future.add_done_callback(
+            lambda _: self.model_loading_finished.emit()
         )
-        self.model_download_worker.moveToThread(self.model_download_thread)
-        self.model_download_thread.started.connect(
-            self.model_download_worker.run
-        )
-        self.model_download_thread.start()
 
-    def _download_and_extract_model(self, model_config):
+    def download_and_extract_model(self, model_config):
         """Download and extract a model from model config"""
         config_file = model_config["config_file"]
         # Check if model is already downloaded
@@ -373,98 +395,95 @@ class ModelManager(QObject):
 
         return model_config
 
-    def _load_model(self, model_id):
+    def _load_model(self, model_id, reload=False):
         """Load and return model info"""
         if self.loaded_model_config is not None:
-            self.loaded_model_config["model"].unload()
+            self.loaded_model_config["model"].deactivate()
             self.loaded_model_config = None
             self.auto_segmentation_model_unselected.emit()
 
+        # Switch to a resident model without loading it again
+        config_file = self.model_configs[model_id]["config_file"]
+        with self.resident_models_lock:
+            if reload:
+                model_config = self.resident_models.pop(config_file, None)
+            else:
+                model_config = self.resident_models.get(config_file)
+                if model_config is not None:
+                    self.resident_models.move_to_end(config_file)
+        if model_config is not None and reload:
+            model_config["model"].unload()
+        elif model_config is not None:
+            if model_config["type"] == "segment_anything":
+                self.auto_segmentation_model_selected.emit()
+                self.request_next_files_requested.emit()
+            self.loaded_model_config = model_config
+            return self.loaded_model_config
+
         model_config = copy.deepcopy(self.model_configs[model_id])
 
         # Download and extract model
         if not model_config.get("has_downloaded", True):
-            model_config = self._download_and_extract_model(model_config)
+            model_config = self.download_and_extract_model(model_config)
             if model_config is None:
                 return
 
             self.model_configs[model_id].update(model_config)
 
-        if model_config["type"] == "yolov5":
-            from .yolov5 import YOLOv5
-
-            try:
-                model_config["model"] = YOLOv5(
-                    model_config, on_message=self.new_model_status.emit
-                )
-                self.auto_segmentation_model_unselected.emit()
-            except Exception as e:  # noqa
-                self.new_model_status.emit(
-                    self.tr(
-                        "Error in loading model: {error_message}".format(
-                            error_message=str(e)
-                        )
-                    )
-                )
-                print(
-                    "Error in loading model: {error_message}".format(
-                        error_message=str(e)
-                    )
-                )
-                return
-        elif model_config["type"] == "yolov8":
-            from .yolov8 import YOLOv8
-
-            try:
-                model_config["model"] = YOLOv8(
-                    model_config, on_message=self.new_model_status.emit
-                )
-                self.auto_segmentation_model_unselected.emit()
-            except Exception as e:  # noqa
-                self.new_model_status.emit(
-                    self.tr(
-                        "Error in loading model: {error_message}".format(
-                            error_message=str(e)
-                        )
-                    )
-                )
-                print(
-                    "Error in loading model: {error_message}".format(
-                        error_message=str(e)
-                    )
-                )
-                return
-        elif model_config["type"] == "segment_anything":
-            from .segment_anything import SegmentAnything
-
-            try:
-                model_config["model"] = SegmentAnything(
-                    model_config, on_message=self.new_model_status.emit
-                )
-                self.auto_segmentation_model_selected.emit()
-            except Exception as e:  # noqa
-                print(
+        try:
+            model_config["model"] = create_model(
+                model_config,
+                on_message=self.new_model_status.emit,
+                executor=self.executor,
+            )
+        except Exception as e:  # noqa
+            self.new_model_status.emit(
+                self.tr(
                     "Error in loading model: {error_message}".format(
                         error_message=str(e)
                     )
                 )
-                self.new_model_status.emit(
-                    self.tr(
-                        "Error in loading model: {error_message}".format(
-                            error_message=str(e)
-                        )
-                    )
+            )
+            print(
+                "Error in loading model: {error_message}".format(
+                    error_message=str(e)
                 )
-                return
+            )
+            return
 
+        if model_config["type"] == "segment_anything":
+            self.auto_segmentation_model_selected.emit()
             # Request next files for prediction
             self.request_next_files_requested.emit()
         else:
-            raise Exception(f"Unknown model type: {model_config['type']}")
+            self.auto_segmentation_model_unselected.emit()
 
         self.loaded_model_config = model_config
+        self.add_resident_model(model_config)
         return self.loaded_model_config
 
+    def add_resident_model(self, model_config):
+        """Keep a loaded model in memory. Least recently used models
+        are unloaded while resident models take more memory than
+        the budget. The added model is never unloaded here."""
+        budget = self.resident_models_memory_mb * 1024 * 1024
+        with self.resident_models_lock:
+            self.resident_models[model_config["config_file"]] = model_config
+            sizes = {
+                key: resident_model_config["model"].get_memory_usage()
+                for key, resident_model_config in self.resident_models.items()
+            }
+            memory_usage = sum(sizes.values())
+            evicted_model_configs = []
+            while len(self.resident_models) > 1 and memory_usage > budget:
+                key, evicted_model_config = self.resident_models.popitem(
+                    last=False
+                )
+                memory_usage -= sizes[key]
+                evicted_model_configs.append(evicted_model_config)
+        for evicted_model_config in evicted_model_configs:
+            evicted_model_config["model"].unload()
+
     def set_auto_labeling_marks(self, marks):
         """Set auto labeling marks
         (For example, for segment_anything model, it is the marks for)
@@ -477,13 +496,34 @@ class ModelManager(QObject):
         self.loaded_model_config["model"].set_auto_labeling_marks(marks)
 
     def unload_model(self):
-        """Unload model"""
+        """Unload model. The model stays in memory as a resident model,
+        it is only unloaded when evicted."""
         if self.loaded_model_config is not None:
-            self.loaded_model_config["model"].unload()
+            self.loaded_model_config["model"].deactivate()
             self.loaded_model_config = None
 
-    def predict_shapes(self, image, filename=None):
+    def _run_prediction(self, image, filename=None, prompts=None):
+        """Run the loaded model and return its result,
+        or None if the prediction failed"""
+        try:
+            model = self.loaded_model_config["model"]
+            if prompts is not None:
+                return model.predict_shapes_from_prompts(
+                    image, prompts, filename
+                )
+            return model.predict_shapes(image, filename)
+        except Exception as e:  # noqa
+            print(f"Error in predict_shapes: {e}")
+            self.new_model_status.emit(
+                self.tr("Error in model prediction. Please check the model.")
+            )
+            return None
+
+    def predict_shapes(self, image, filename=None, prompts=None):
         """Predict shapes.
+        If prompts (a list of lists of marks) is given, one object is
+        predicted for each prompt in a single model run. Only supported
+        by segment_anything models.
         NOTE: This function is blocking. The model can take a long time to
         predict. So it is recommended to use predict_shapes_threading instead.
         """
@@ -493,64 +533,94 @@ class ModelManager(QObject):
             )
             self.prediction_finished.emit()
             return
-        try:
-            auto_labeling_result = self.loaded_model_config[
-                "model"
-            ].predict_shapes(image, filename)
+        auto_labeling_result = self._run_prediction(image, filename, prompts)
+        if auto_labeling_result is not None:
             self.new_auto_labeling_result.emit(auto_labeling_result)
-        except Exception as e:  # noqa
-            print(f"Error in predict_shapes: {e}")
-            self.new_model_status.emit(
-                self.tr("Error in model prediction. Please check the model.")
-            )
         self.new_model_status.emit(
             self.tr("Finished inferencing AI model. Check the result.")
         )
         self.prediction_finished.emit()
 
     @pyqtSlot()
-    def predict_shapes_threading(self, image, filename=None):
+    def predict_shapes_threading(self, image, filename=None, prompts=None):
         """Predict shapes.
-        This function starts a thread to run the prediction.
+        The prediction runs on the interactive lane of the executor. If a
+        prediction is already running, the request is queued and replaces
+        any request queued before, so rapid requests converge on the
+        latest one.
         """
         if self.loaded_model_config is None:
             self.new_model_status.emit(
                 self.tr("Model is not loaded. Choose a mode to continue.")
             )
             return
+        if prompts is not None and not hasattr(
+            self.loaded_model_config["model"], "predict_shapes_from_prompts"
+        ):
+            self.new_model_status.emit(
+                self.tr("This model does not support prompts.")
+            )
+            return
+
+        with self.model_execution_lock:
+            self.prediction_request_id += 1
+            request = (self.prediction_request_id, image, filename, prompts)
+            if self.model_execution_busy:
+                self.pending_prediction_request = request
+                return
+            self.model_execution_busy = True
+
         self.new_model_status.emit(
             self.tr("Inferencing AI model. Please wait...")
         )
         self.prediction_started.emit()
+        self._submit_prediction_requests(request)
 
-        with self.model_execution_thread_lock:
-            if (
-                self.model_execution_thread is not None
-                and self.model_execution_thread.isRunning()
-            ):
-                self.new_model_status.emit(
-                    self.tr(
-                        "Another model is being executed."
-                        " Please wait for it to finish."
-                    )
-                )
-                self.prediction_finished.emit()
-                return
+    def _submit_prediction_requests(self, request):
+        """Run a prediction request and the requests queued while it runs
+        on the interactive lane"""
+        future = self.executor.submit(
+            LANE_INTERACTIVE, self._run_prediction_requests, request
+        )
+        future.add_done_callback(
+            lambda _: self.model_execution_finished.emit()
+        )
 
-            self.model_execution_thread = QThread()
-            self.model_execution_worker = GenericWorker(
-                self.predict_shapes, image, filename
-            )
-            self.model_execution_worker.finished.connect(
-                self.model_execution_thread.quit
-            )
-            self.model_execution_worker.moveToThread(
-                self.model_execution_thread
-            )
-            self.model_execution_thread.started.connect(
-                self.model_execution_worker.run
+    def _run_prediction_requests(self, request):
+        """Run a prediction request, then the requests queued meanwhile.
+        Results of requests superseded by a newer request are discarded.
+        """
+        while request is not None:
+            request_id, image, filename, prompts = request
+            auto_labeling_result = self._run_prediction(
+                image, filename, prompts
             )
-            self.model_execution_thread.start()
+            with self.model_execution_lock:
+                if (
+                    auto_labeling_result is not None
+                    and request_id == self.prediction_request_id
+                ):
+                    self.new_auto_labeling_result.emit(auto_labeling_result)
+                request = self.pending_prediction_request
+                self.pending_prediction_request = None
+
+    @pyqtSlot()
+    def on_model_execution_finished(self):
+        """Handle prediction requests finished"""
+        with self.model_execution_lock:
+            # A request may have been queued after the worker stopped
+            request = self.pending_prediction_request
+            self.pending_prediction_request = None
+            if request is None:
+                self.model_execution_busy = False
+        if request is not None:
+            self._submit_prediction_requests(request)
+            return
+
+        self.new_model_status.emit(
+            self.tr("Finished inferencing AI model. Check the result.")
+        )
+        self.prediction_finished.emit()
 
     def on_next_files_changed(self, next_files):
         """Run prediction on next files in advance to save inference time later"""
@@ -0,0 +1,194 @@
+"""Create ONNX Runtime inference sessions from config options."""
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+import onnxruntime
+
+EXECUTION_MODES = {
+    "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable_all": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+OPTIMIZED_MODEL_SUFFIX = ".optimized.onnx"
+
+# Options which are set as is on onnxruntime.SessionOptions
+PLAIN_SESSION_OPTIONS = [
+    "intra_op_num_threads",
+    "inter_op_num_threads",
+    "enable_cpu_mem_arena",
+    "enable_mem_pattern",
+]
+
+
+def create_session_options(options=None):
+    """Create onnxruntime.SessionOptions from a dict of options,
+    as written in config files. None values keep ONNX Runtime defaults.
+
+    Supported options: intra_op_num_threads, inter_op_num_threads,
+    execution_mode (sequential, parallel), graph_optimization_level
+    (disable_all, basic, extended, all), enable_cpu_mem_arena and
+    enable_mem_pattern.
+    """
+    session_options = onnxruntime.SessionOptions()
+    for name, value in (options or {}).items():
+        if value is None:
+            continue
+        if name == "execution_mode":
+            if value not in EXECUTION_MODES:
+                raise ValueError(f"Unknown execution_mode: {value}")
+            session_options.execution_mode = EXECUTION_MODES[value]
+        elif name == "graph_optimization_level":
+            if value not in GRAPH_OPTIMIZATION_LEVELS:
+                raise ValueError(f"Unknown graph_optimization_level: {value}")
+            session_options.graph_optimization_level = (
+                GRAPH_OPTIMIZATION_LEVELS[value]
+            )
+        elif name in PLAIN_SESSION_OPTIONS:
+            setattr(session_options, name, value)
+        else:
+            raise ValueError(f"Unknown session option: {name}")
+    return session_options
+
+
+def get_optimized_model_path(model_path, options=None, providers=None):
+    """Get the path of the cached optimized graph of a model, next to the
+    model. The path depends on the model file, the ONNX Runtime version,
+    the providers and the graph optimization level, so that a stale graph
+    is never reused."""
+    stat = os.stat(model_path)
+    key = "|".join(
+        [
+            onnxruntime.__version__,
+            ",".join(providers or []),
+            str((options or {}).get("graph_optimization_level")),
+            str(stat.st_size),
+            str(stat.st_mtime_ns),
+        ]
+    )
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    root, _ = os.path.splitext(model_path)
+    return f"{root}.{digest}{OPTIMIZED_MODEL_SUFFIX}"
+
+
+def remove_optimized_models(model_path, keep=None):
+    """Remove cached optimized graphs of a model, except keep"""
+    root, _ = os.path.splitext(model_path)
+    pattern = glob.escape(root) + ".*" + OPTIMIZED_MODEL_SUFFIX
+    for path in glob.glob(pattern) + glob.glob(pattern + ".data"):
+        if keep is None or path not in (keep, keep + ".data"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def save_optimized_model(
+    model_path, optimized_model_path, options=None, providers=None
+):
+    """Optimize the graph of a model and save it to optimized_model_path"""
+    # Layout optimizations of the "all" level are hardware specific:
+    # they are left out of the saved graph and run on every load
+    options = dict(options or {})
+    if options.get("graph_optimization_level") in (None, "all"):
+        options["graph_optimization_level"] = "extended"
+
+    # Write to a temporary folder first, then move files into place
+    # so that readers never see a partially written graph
+    tmp_dir = tempfile.mkdtemp(
+        prefix=".", dir=os.path.dirname(optimized_model_path)
+    )
+    try:
+        name = os.path.basename(optimized_model_path)
+        session_options = create_session_options(options)
+        session_options.optimized_model_filepath = os.path.join(tmp_dir, name)
+        # Weights go to a separate file, as protobuf cannot hold
+        # models larger than 2 GB
+        session_options.add_session_config_entry(
+            "session.optimized_model_external_initializers_file_name",
+            name + ".data",
+        )
+        onnxruntime.InferenceSession(
+            model_path,
+            sess_options=session_options,
+            providers=providers,
+        )
+
+        # The graph file is moved last: it marks a complete cache entry
+        data_path = os.path.join(tmp_dir, name + ".data")
+        if os.path.isfile(data_path):
+            os.replace(data_path, optimized_model_path + ".data")
+        os.replace(os.path.join(tmp_dir, name), optimized_model_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    remove_optimized_models(model_path, keep=optimized_model_path)
+
+
+def create_inference_session(
+    model_path, options=None, providers=None, cache_optimized_model=False
+):
+    """Create an onnxruntime.InferenceSession with options from config.
+
+    If cache_optimized_model is True, the graph optimized by ONNX Runtime
+    is saved next to the model on the first load and loaded instead of
+    the model on later loads, skipping most graph optimizations.
+    """
+    options = options or {}
+    if (
+        cache_optimized_model
+        and options.get("graph_optimization_level") != "disable_all"
+    ):
+        optimized_model_path = get_optimized_model_path(
+            model_path, options, providers
+        )
+        try:
+            if not os.path.isfile(optimized_model_path):
+                save_optimized_model(
+                    model_path, optimized_model_path, options, providers
+                )
+            return onnxruntime.InferenceSession(
+                optimized_model_path,
+                sess_options=create_session_options(options),
+                providers=providers,
+            )
+        except Exception as e:  # noqa
+            logging.warning(
+                "Could not use optimized model of %s: %s", model_path, e
+            )
+            remove_optimized_models(model_path)
+
+    return onnxruntime.InferenceSession(
+        model_path,
+        sess_options=create_session_options(options),
+        providers=providers,
+    )
+
+
+def create_inference_sessions(
+    models, providers=None, cache_optimized_model=False
+):
+    """Create sessions for a list of (model_path, options) in parallel.
+    Returns the sessions in the order of models."""
+    with ThreadPoolExecutor(max_workers=len(models)) as pool:
+        futures = [
+            pool.submit(
+                create_inference_session,
+                model_path,
+                options,
+                providers,
+                cache_optimized_model,
+            )
+            for model_path, options in models
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,106 @@
+"""Priority scheduler for background preloading jobs."""
+import heapq
+import logging
+import threading
+import traceback
+
+from .inference_executor import InferenceExecutor, LANE_PRELOAD
+
+
+class PreloadScheduler:
+    """Run preloading jobs on a lane of an inference executor.
+
+    Jobs are processed by priority: the first item of the list passed to
+    `schedule()` has the highest priority. Scheduling a new list cancels
+    all pending jobs of the previous one, so the worker never spends time
+    on files the user has already skipped. Every batch of items is
+    submitted as a separate executor job, so the lane can yield to
+    interactive work between batches.
+    """
+
+    def __init__(
+        self, process_func, batch_size=1, executor=None, lane=LANE_PRELOAD
+    ):
+        """Initialize the scheduler
+
+        Args:
+            process_func (Callable): Function called as
+                `process_func(items, priorities)` with up to `batch_size`
+                scheduled items, sorted by priority.
+            batch_size (int, optional): Max number of items per call.
+            executor (InferenceExecutor, optional): Executor running the
+                jobs. If None, the scheduler runs its own executor.
+            lane (str, optional): Executor lane of the jobs.
+        """
+        self.process_func = process_func
+        self.batch_size = batch_size
+        self.owns_executor = executor is None
+        if executor is None:
+            executor = InferenceExecutor([lane])
+        self.executor = executor
+        self.lane = lane
+        self._queue = []
+        self._generation = 0
+        self._stopped = False
+        self._future = None
+        self._lock = threading.Lock()
+
+    def schedule(self, items):
+        """Replace pending jobs by a new list of items,
+        sorted by decreasing priority"""
+        with self._lock:
+            if self._stopped:
+                return
+            self._generation += 1
+            self._queue = [
+                (priority, self._generation, item)
+                for priority, item in enumerate(items)
+            ]
+            heapq.heapify(self._queue)
+            self._submit()
+
+    def cancel(self):
+        """Cancel all pending jobs"""
+        with self._lock:
+            self._generation += 1
+            self._queue = []
+
+    def stop(self):
+        """Cancel pending jobs. The running job is not interrupted."""
+        with self._lock:
+            self._stopped = True
+            self._queue = []
+            future = self._future
+        if future is not None:
+            future.cancel()
+        if self.owns_executor:
+            self.executor.shutdown()
+
+    def _submit(self):
+        """Submit a job for the next batch if none is submitted yet.
+        Lock must be held."""
+        if self._queue and (self._future is None or self._future.cancelled()):
+            self._future = self.executor.submit(
+                self.lane, self._process_next_batch, priority=self._queue[0][0]
+            )
+
+    def _process_next_batch(self):
+        with self._lock:
+            jobs = [
+                heapq.heappop(self._queue)
+                for _ in range(min(self.batch_size, len(self._queue)))
+            ]
+        try:
+            if jobs and not self._stopped:
+                items = [item for _, _, item in jobs]
+                priorities = [priority for priority, _, _ in jobs]
+                try:
+                    self.process_func(items, priorities)
+                except Exception as e:  # noqa
+                    logging.warning("Could not preload %s: %s", items, e)
+                    traceback.print_exc()
+        finally:
+            with self._lock:
+                self._future = None
+                if not self._stopped:
+                    self._submit()
@@ -4,17 +4,20 @@ from typing import Any
 
 import cv2
 import numpy as np
-import onnxruntime
 from numpy import ndarray
 
+from .mask_roi import get_resize_matrix, warp_mask_roi
+
 
 class SegmentAnything2ONNX:
     """Segmentation model using Segment Anything 2 (SAM2)"""
 
-    def __init__(self, encoder_model_path, decoder_model_path) -> None:
-        self.encoder = SAM2ImageEncoder(encoder_model_path)
+    def __init__(self, encoder_session, decoder_session) -> None:
+        """Initialize the model from ONNX Runtime sessions
+        of the encoder and the decoder"""
+        self.encoder = SAM2ImageEncoder(encoder_session)
         self.decoder = SAM2ImageDecoder(
-            decoder_model_path, self.encoder.input_shape[2:]
+            decoder_session, self.encoder.input_shape[2:]
         )
 
     def encode(self, cv_image: np.ndarray) -> list[np.ndarray]:
@@ -27,7 +30,30 @@ class SegmentAnything2ONNX:
             "original_size": original_size,
         }
 
-    def predict_masks(self, embedding, prompt) -> list[np.ndarray]:
+    @property
+    def supports_batch_encoding(self) -> bool:
+        return self.encoder.supports_batch
+
+    def encode_many(self, cv_images: list[np.ndarray]) -> list[dict]:
+        """Encode a list of images, in a single run if the encoder
+        has a dynamic batch dimension."""
+        outputs = self.encoder.encode_images(cv_images)
+        return [
+            {
+                "high_res_feats_0": high_res_feats_0,
+                "high_res_feats_1": high_res_feats_1,
+                "image_embedding": image_embed,
+                "original_size": cv_image.shape[:2],
+            }
+            for cv_image, (
+                high_res_feats_0,
+                high_res_feats_1,
+                image_embed,
+            ) in zip(cv_images, outputs)
+        ]
+
+    @staticmethod
+    def get_input_points(prompt) -> tuple[np.ndarray, np.ndarray]:
         points = []
         labels = []
         for mark in prompt:
@@ -42,6 +68,10 @@ class SegmentAnything2ONNX:
                 labels.append(2)
                 labels.append(3)
         points, labels = np.array(points), np.array(labels)
+        return points, labels
+
+    def predict_masks(self, embedding, prompt) -> list[np.ndarray]:
+        points, labels = self.get_input_points(prompt)
 
         image_embedding = embedding["image_embedding"]
         high_res_feats_0 = embedding["high_res_feats_0"]
@@ -58,6 +88,53 @@ class SegmentAnything2ONNX:
 
         return masks
 
+    def predict_low_res_masks_batch(
+        self, embedding, prompts
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Predict one mask for each of several independent prompts, at
+        the decoder output size, in a single decoder run if the decoder
+        has a dynamic batch dimension. Returns mask logits and scores."""
+        points = [self.get_input_points(prompt) for prompt in prompts]
+        if self.decoder.supports_batch:
+            batches = [points]
+        else:
+            batches = [[prompt_points] for prompt_points in points]
+
+        self.decoder.set_image_size(embedding["original_size"])
+        outputs = [
+            self.decoder.predict_low_res_batch(
+                embedding["image_embedding"],
+                embedding["high_res_feats_0"],
+                embedding["high_res_feats_1"],
+                [coords for coords, _ in batch],
+                [labels for _, labels in batch],
+            )
+            for batch in batches
+        ]
+        return (
+            np.concatenate([masks for masks, _ in outputs]),
+            np.concatenate([scores for _, scores in outputs]),
+        )
+
+    def predict_mask_rois(self, embedding, prompts) -> list[tuple]:
+        """Predict one mask for each of several independent prompts.
+        Masks are upscaled to the original image size only around the
+        objects. Returns a list of (mask, (x, y) offset in the original
+        image)."""
+        masks, _ = self.predict_low_res_masks_batch(embedding, prompts)
+        original_size = embedding["original_size"]
+        resize_matrix = get_resize_matrix(masks.shape[1:], original_size)
+        return [
+            warp_mask_roi(
+                mask,
+                resize_matrix,
+                original_size,
+                threshold=self.decoder.mask_threshold,
+                border_mode=cv2.BORDER_REPLICATE,
+            )
+            for mask in masks
+        ]
+
     def transform_masks(self, masks, original_size, transform_matrix):
         """Transform the masks back to the original image size."""
         output_masks = []
@@ -77,11 +154,9 @@ class SegmentAnything2ONNX:
 
 
 class SAM2ImageEncoder:
-    def __init__(self, path: str) -> None:
+    def __init__(self, session) -> None:
         # Initialize model
-        self.session = onnxruntime.InferenceSession(
-            path, providers=onnxruntime.get_available_providers()
-        )
+        self.session = session
 
         # Get model info
         self.get_input_details()
@@ -101,6 +176,27 @@ class SAM2ImageEncoder:
 
         return self.process_output(outputs)
 
+    def encode_images(
+        self, images: list[np.ndarray]
+    ) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        if not self.supports_batch or len(images) <= 1:
+            return [self.encode_image(image) for image in images]
+
+        input_tensor = np.concatenate(
+            [self.prepare_input(image) for image in images]
+        )
+
+        outputs = self.infer(input_tensor)
+
+        # Copies of the outputs, which are cached image by image: views
+        # would keep the outputs of the whole batch in memory
+        return [
+            self.process_output(
+                [output[i : i + 1].copy() for output in outputs]
+            )
+            for i in range(len(images))
+        ]
+
     def prepare_input(self, image: np.ndarray) -> np.ndarray:
         self.img_height, self.img_width = image.shape[:2]
 
@@ -136,6 +232,7 @@ class SAM2ImageEncoder:
         ]
 
         self.input_shape = model_inputs[0].shape
+        self.supports_batch = not isinstance(self.input_shape[0], int)
         self.input_height = self.input_shape[2]
         self.input_width = self.input_shape[3]
 
@@ -149,15 +246,13 @@ class SAM2ImageEncoder:
 class SAM2ImageDecoder:
     def __init__(
         self,
-        path: str,
+        session,
         encoder_input_size: tuple[int, int],
         orig_im_size: tuple[int, int] = None,
         mask_threshold: float = 0.0,
     ) -> None:
         # Initialize model
-        self.session = onnxruntime.InferenceSession(
-            path, providers=onnxruntime.get_available_providers()
-        )
+        self.session = session
 
         self.orig_im_size = (
             orig_im_size if orig_im_size is not None else encoder_input_size
@@ -208,6 +303,34 @@ class SAM2ImageDecoder:
 
         return self.process_output(outputs)
 
+    def predict_low_res_batch(
+        self,
+        image_embed: np.ndarray,
+        high_res_feats_0: np.ndarray,
+        high_res_feats_1: np.ndarray,
+        point_coords: list[np.ndarray],
+        point_labels: list[np.ndarray],
+    ) -> tuple[np.ndarray, np.ndarray]:
+        inputs = self.prepare_inputs(
+            image_embed,
+            high_res_feats_0,
+            high_res_feats_1,
+            point_coords,
+            point_labels,
+        )
+
+        outputs = self.infer(inputs)
+
+        # Select the best mask of every prompt, without resizing
+        masks = outputs[0]
+        scores = outputs[1].reshape(masks.shape[0], -1)
+        best_mask_ids = np.argmax(scores, axis=1)
+        prompt_ids = np.arange(masks.shape[0])
+        return (
+            masks[prompt_ids, best_mask_ids],
+            scores[prompt_ids, best_mask_ids],
+        )
+
     def prepare_inputs(
         self,
         image_embed: np.ndarray,
@@ -324,6 +447,11 @@ class SAM2ImageDecoder:
         self.input_names = [
             model_inputs[i].name for i in range(len(model_inputs))
         ]
+        self.supports_batch = any(
+            model_input.name == "point_coords"
+            and not isinstance(model_input.shape[0], int)
+            for model_input in model_inputs
+        )
 
     def get_output_details(self) -> None:
         model_outputs = self.session.get_outputs()
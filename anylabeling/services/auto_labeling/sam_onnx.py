@@ -3,22 +3,36 @@ from copy import deepcopy
 
 import cv2
 import numpy as np
-import onnxruntime
+
+from .mask_roi import warp_mask_roi
+
+
+def is_dynamic_batch(input_shape):
+    """Check if the first dimension of a model input is a dynamic
+    batch dimension"""
+    return len(input_shape) > 0 and not isinstance(input_shape[0], int)
 
 
 class SegmentAnythingONNX:
     """Segmentation model using SegmentAnything"""
 
-    def __init__(self, encoder_model_path, decoder_model_path) -> None:
+    def __init__(self, encoder_session, decoder_session) -> None:
+        """Initialize the model from ONNX Runtime sessions
+        of the encoder and the decoder"""
         self.target_size = 1024
         self.input_size = (684, 1024)
 
-        self.encoder_session = onnxruntime.InferenceSession(
-            encoder_model_path
-        )
+        self.encoder_session = encoder_session
         self.encoder_input_name = self.encoder_session.get_inputs()[0].name
-        self.decoder_session = onnxruntime.InferenceSession(
-            decoder_model_path
+        encoder_input_shape = self.encoder_session.get_inputs()[0].shape
+        self.supports_batch_encoding = len(
+            encoder_input_shape
+        ) == 4 and is_dynamic_batch(encoder_input_shape)
+        self.decoder_session = decoder_session
+        self.supports_batch_decoding = any(
+            decoder_input.name == "point_coords"
+            and is_dynamic_batch(decoder_input.shape)
+            for decoder_input in self.decoder_session.get_inputs()
         )
 
     def get_input_points(self, prompt):
@@ -70,10 +84,8 @@ class SegmentAnythingONNX:
         coords[..., 1] = coords[..., 1] * (new_h / old_h)
         return coords
 
-    def run_decoder(
-        self, image_embedding, original_size, transform_matrix, prompt
-    ):
-        """Run decoder"""
+    def get_decoder_points(self, prompt, transform_matrix):
+        """Get point coordinates and labels of a prompt for the decoder"""
         input_points, input_labels = self.get_input_points(prompt)
 
         # Add a batch index, concatenate a padding point, and transform.
@@ -97,9 +109,52 @@ class SegmentAnythingONNX:
         )
         onnx_coord = np.matmul(onnx_coord, transform_matrix.T)
         onnx_coord = onnx_coord[:, :, :2].astype(np.float32)
+        return onnx_coord, onnx_label
+
+    def run_decoder(
+        self, image_embedding, original_size, transform_matrix, prompt
+    ):
+        """Run decoder"""
+        onnx_coord, onnx_label = self.get_decoder_points(
+            prompt, transform_matrix
+        )
+        masks, _ = self.decode_points(image_embedding, onnx_coord, onnx_label)
 
+        # Transform the masks back to the original image size.
+        inv_transform_matrix = np.linalg.inv(transform_matrix)
+        transformed_masks = self.transform_masks(
+            masks, original_size, inv_transform_matrix
+        )
+
+        return transformed_masks
+
+    def get_batch_decoder_points(self, prompts, transform_matrix):
+        """Get point coordinates and labels of several prompts,
+        padded to the same number of points"""
+        # Pad prompts with (0, 0) points labeled -1,
+        # like the padding point of a single prompt
+        points = [
+            self.get_decoder_points(prompt, transform_matrix)
+            for prompt in prompts
+        ]
+        max_num_points = max(coord.shape[1] for coord, _ in points)
+        onnx_coord = np.zeros(
+            (len(prompts), max_num_points, 2), dtype=np.float32
+        )
+        onnx_label = -np.ones((len(prompts), max_num_points), dtype=np.float32)
+        for i, (coord, label) in enumerate(points):
+            onnx_coord[i, : coord.shape[1]] = coord[0]
+            onnx_label[i, : label.shape[1]] = label[0]
+        return onnx_coord, onnx_label
+
+    def decode_points(self, image_embedding, onnx_coord, onnx_label):
+        """Run decoder on a batch of prepared points.
+        Returns masks at the encoder input size and their predicted IoU.
+        """
         # Create an empty mask input and an indicator for no mask.
-        onnx_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
+        onnx_mask_input = np.zeros(
+            (onnx_coord.shape[0], 1, 256, 256), dtype=np.float32
+        )
         onnx_has_mask_input = np.zeros(1, dtype=np.float32)
 
         decoder_inputs = {
@@ -110,15 +165,10 @@ class SegmentAnythingONNX:
             "has_mask_input": onnx_has_mask_input,
             "orig_im_size": np.array(self.input_size, dtype=np.float32),
         }
-        masks, _, _ = self.decoder_session.run(None, decoder_inputs)
-
-        # Transform the masks back to the original image size.
-        inv_transform_matrix = np.linalg.inv(transform_matrix)
-        transformed_masks = self.transform_masks(
-            masks, original_size, inv_transform_matrix
+        masks, iou_predictions, _ = self.decoder_session.run(
+            None, decoder_inputs
         )
-
-        return transformed_masks
+        return masks, iou_predictions
 
     def transform_masks(self, masks, original_size, transform_matrix):
         """Transform masks
@@ -139,9 +189,11 @@ class SegmentAnythingONNX:
             output_masks.append(batch_masks)
         return np.array(output_masks)
 
-    def encode(self, cv_image):
+    def preprocess(self, cv_image):
         """
-        Calculate embedding and metadata for a single image.
+        Resize an image to the encoder input size.
+        Returns the encoder input, the original size and
+        the transformation matrix.
         """
         original_size = cv_image.shape[:2]
 
@@ -162,9 +214,17 @@ class SegmentAnythingONNX:
             (self.input_size[1], self.input_size[0]),
             flags=cv2.INTER_LINEAR,
         )
+        return cv_image.astype(np.float32), original_size, transform_matrix
 
+    def encode(self, cv_image):
+        """
+        Calculate embedding and metadata for a single image.
+        """
+        input_image, original_size, transform_matrix = self.preprocess(
+            cv_image
+        )
         encoder_inputs = {
-            self.encoder_input_name: cv_image.astype(np.float32),
+            self.encoder_input_name: input_image,
         }
         image_embedding = self.run_encoder(encoder_inputs)
         return {
@@ -173,6 +233,33 @@ class SegmentAnythingONNX:
             "transform_matrix": transform_matrix,
         }
 
+    def encode_many(self, cv_images):
+        """
+        Calculate embeddings and metadata for a list of images.
+        Images are encoded in a single run if the encoder has a dynamic
+        batch dimension, otherwise one by one.
+        """
+        if not self.supports_batch_encoding or len(cv_images) <= 1:
+            return [self.encode(cv_image) for cv_image in cv_images]
+
+        inputs = [self.preprocess(cv_image) for cv_image in cv_images]
+        encoder_inputs = {
+            self.encoder_input_name: np.stack(
+                [input_image for input_image, _, _ in inputs]
+            ),
+        }
+        image_embeddings = self.run_encoder(encoder_inputs)
+        # Copies of the embeddings, which are cached one by one: views
+        # would keep the embeddings of the whole batch in memory
+        return [
+            {
+                "image_embedding": image_embeddings[i : i + 1].copy(),
+                "original_size": original_size,
+                "transform_matrix": transform_matrix,
+            }
+            for i, (_, original_size, transform_matrix) in enumerate(inputs)
+        ]
+
     def predict_masks(self, embedding, prompt):
         """
         Predict masks for a single image.
@@ -185,3 +272,46 @@ class SegmentAnythingONNX:
         )
 
         return masks
+
+    def predict_low_res_masks_batch(self, embedding, prompts):
+        """
+        Predict one mask for each of several independent prompts, at the
+        encoder input size. Prompts are decoded in a single run if the
+        decoder has a dynamic batch dimension, otherwise one by one.
+        Returns mask logits and predicted IoU.
+        """
+        image_embedding = embedding["image_embedding"]
+        transform_matrix = embedding["transform_matrix"]
+        if self.supports_batch_decoding:
+            masks, iou_predictions = self.decode_points(
+                image_embedding,
+                *self.get_batch_decoder_points(prompts, transform_matrix),
+            )
+        else:
+            outputs = [
+                self.decode_points(
+                    image_embedding,
+                    *self.get_decoder_points(prompt, transform_matrix),
+                )
+                for prompt in prompts
+            ]
+            masks = np.concatenate([masks for masks, _ in outputs])
+            iou_predictions = np.concatenate(
+                [iou_predictions for _, iou_predictions in outputs]
+            )
+        return masks[:, 0], iou_predictions[:, 0]
+
+    def predict_mask_rois(self, embedding, prompts):
+        """
+        Predict one mask for each of several independent prompts. Masks
+        are upscaled to the original image size only around the objects.
+        Returns a list of (mask, (x, y) offset in the original image).
+        """
+        masks, _ = self.predict_low_res_masks_batch(embedding, prompts)
+        inv_transform_matrix = np.linalg.inv(embedding["transform_matrix"])
+        return [
+            warp_mask_roi(
+                mask, inv_transform_matrix, embedding["original_size"]
+            )
+            for mask in masks
+        ]
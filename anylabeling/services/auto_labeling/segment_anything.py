@@ -3,22 +3,34 @@ import os
 import traceback
 
 import cv2
-import onnx
 import numpy as np
+import onnxruntime
 from PyQt5 import QtCore
-from PyQt5.QtCore import QThread
 from PyQt5.QtCore import QCoreApplication
 
-from anylabeling.utils import GenericWorker
 from anylabeling.views.labeling.shape import Shape
 from anylabeling.views.labeling.utils.opencv import qt_img_to_rgb_cv_img
 
+from .automatic_mask_generator import AutomaticMaskGenerator
+from .embedding_store import EmbeddingStore
 from .lru_cache import LRUCache
 from .model import Model
+from .onnx_session import create_inference_sessions
+from .preload_scheduler import PreloadScheduler
 from .types import AutoLabelingResult
 from .sam_onnx import SegmentAnythingONNX
 from .sam2_onnx import SegmentAnything2ONNX
 
+DEFAULT_EMBEDDING_CACHE_MEMORY_MB = 256
+
+# Number of cached embeddings kept for recently visited images
+# when sizing the preloading window
+NUM_RESERVED_EMBEDDINGS = 3
+
+DEFAULT_PRELOAD_BATCH_SIZE = 4
+
+DEFAULT_CONTOUR_APPROX_EPSILON = 0.001
+
 
 class SegmentAnything(Model):
     """Segmentation model using SegmentAnything"""
@@ -34,6 +46,7 @@ class SegmentAnything(Model):
         widgets = [
             "output_label",
             "output_select_combobox",
+            "button_run",
             "button_add_point",
             "button_remove_point",
             "button_add_rect",
@@ -43,10 +56,13 @@ class SegmentAnything(Model):
         output_modes = {
             "polygon": QCoreApplication.translate("Model", "Polygon"),
             "rectangle": QCoreApplication.translate("Model", "Rectangle"),
+            "everything": QCoreApplication.translate(
+                "Model", "Segment Everything"
+            ),
         }
         default_output_mode = "polygon"
 
-    def __init__(self, config_path, on_message) -> None:
+    def __init__(self, config_path, on_message, executor=None) -> None:
         # Run the parent class's init method
         super().__init__(config_path, on_message)
         self.input_size = self.config["input_size"]
@@ -79,144 +95,240 @@ class SegmentAnything(Model):
                 )
             )
 
-        # Load models
-        if self.detect_model_variant(decoder_model_abs_path) == "sam2":
-            self.model = SegmentAnything2ONNX(
-                encoder_model_abs_path, decoder_model_abs_path
-            )
+        # Load models: encoder and decoder sessions are built in parallel,
+        # optimized graphs are cached next to the models
+        encoder_session, decoder_session = create_inference_sessions(
+            [
+                (
+                    encoder_model_abs_path,
+                    self.get_session_options("encoder_session_options"),
+                ),
+                (
+                    decoder_model_abs_path,
+                    self.get_session_options("decoder_session_options"),
+                ),
+            ],
+            providers=onnxruntime.get_available_providers(),
+            cache_optimized_model=self.config.get(
+                "cache_optimized_model", True
+            ),
+        )
+        if self.detect_model_variant(decoder_session) == "sam2":
+            model_class = SegmentAnything2ONNX
         else:
-            self.model = SegmentAnythingONNX(
-                encoder_model_abs_path, decoder_model_abs_path
-            )
+            model_class = SegmentAnythingONNX
+        self.model = model_class(encoder_session, decoder_session)
 
         # Mark for auto labeling
         # points, rectangles
         self.marks = []
 
-        # Cache for image embedding
-        self.cache_size = 10
-        self.preloaded_size = self.cache_size - 3
-        self.image_embedding_cache = LRUCache(self.cache_size)
+        # Cache for image embedding, limited by memory size
+        self.cache_memory_mb = self.config.get(
+            "embedding_cache_memory_mb", DEFAULT_EMBEDDING_CACHE_MEMORY_MB
+        )
+        self.image_embedding_cache = LRUCache(
+            maxsize=None, max_bytes=self.cache_memory_mb * 1024 * 1024
+        )
+
+        # Persistent cache for image embedding, shared between sessions
+        self.embedding_store = None
+        if self.config.get("embedding_store_enabled", True):
+            self.embedding_store = EmbeddingStore(
+                EmbeddingStore.get_namespace(
+                    self.config["name"], encoder_model_abs_path
+                ),
+                cache_dir=self.config.get("embedding_store_dir"),
+                max_size_mb=self.config.get("embedding_store_quota_mb"),
+            )
+
+        # Polygon simplification tolerance, relative to contour perimeter
+        self.contour_approx_epsilon = self.config.get(
+            "contour_approx_epsilon", DEFAULT_CONTOUR_APPROX_EPSILON
+        )
+
+        # Generator for the "everything" output mode, run from the Run
+        # button only. SAM1 decoders with a batch size of 1 decode the
+        # grid point by point, lower points_per_side to speed them up.
+        self.mask_generator = AutomaticMaskGenerator(
+            self.model, **self.config.get("segment_everything", {})
+        )
 
-        # Pre-inference worker
-        self.pre_inference_thread = None
-        self.pre_inference_worker = None
+        # Pre-inference jobs, run on the preload lane of the executor
+        # Several files are encoded in a single run only if the encoder
+        # supports it, otherwise one by one to cancel stale jobs quickly
+        preload_batch_size = 1
+        if self.model.supports_batch_encoding:
+            preload_batch_size = self.config.get(
+                "preload_batch_size", DEFAULT_PRELOAD_BATCH_SIZE
+            )
+        self.preload_scheduler = PreloadScheduler(
+            self.preload_files,
+            batch_size=preload_batch_size,
+            executor=executor,
+        )
         self.stop_inference = False
 
-    def detect_model_variant(self, decoder_model_abs_path):
-        """Load and detect model variant based on the model architecture"""
-        model = onnx.load(decoder_model_abs_path)
-        input_names = [input.name for input in model.graph.input]
+    @staticmethod
+    def detect_model_variant(decoder_session):
+        """Detect model variant from the inputs of the decoder session"""
+        input_names = [input.name for input in decoder_session.get_inputs()]
         if "high_res_feats_0" in input_names:
             return "sam2"
         return "sam"
 
+    def get_image_embedding(self, filename, image=None):
+        """Get image embedding from caches, or run the encoder on a miss.
+        Concurrent requests for the same file (e.g. from the preloading
+        worker and from user interaction) share a single encoding."""
+        if not filename:
+            return self.model.encode(qt_img_to_rgb_cv_img(image))
+        return self.image_embedding_cache.get_or_compute(
+            filename, self.load_or_encode, filename, image
+        )
+
+    def load_or_encode(self, filename, image=None):
+        """Load image embedding from the persistent embedding store,
+        or run the encoder and save the result to the store.
+        If image is None, it is loaded from filename."""
+        use_store = self.embedding_store is not None and os.path.isfile(
+            filename
+        )
+        if use_store:
+            image_embedding = self.embedding_store.get(filename)
+            if image_embedding is not None:
+                return image_embedding
+
+        if image is None:
+            image = self.load_image_from_filename(filename)
+            if image is None:
+                return None
+            cv_image = qt_img_to_rgb_cv_img(image)
+        else:
+            cv_image = qt_img_to_rgb_cv_img(image, filename)
+        if self.stop_inference:
+            return None
+        image_embedding = self.model.encode(cv_image)
+        if use_store:
+            self.embedding_store.put(filename, image_embedding)
+        return image_embedding
+
+    def load_or_encode_many(self, filenames):
+        """Load image embeddings from the persistent embedding store,
+        or run the encoder on all missing images at once.
+        Returns a list of embeddings, None for images that
+        could not be loaded."""
+        embeddings = {}
+        cv_images = {}
+        for filename in filenames:
+            use_store = self.embedding_store is not None and os.path.isfile(
+                filename
+            )
+            if use_store:
+                embeddings[filename] = self.embedding_store.get(filename)
+                if embeddings[filename] is not None:
+                    continue
+            image = self.load_image_from_filename(filename)
+            if image is None:
+                continue
+            cv_images[filename] = qt_img_to_rgb_cv_img(image)
+
+        if cv_images and not self.stop_inference:
+            image_embeddings = self.model.encode_many(list(cv_images.values()))
+            for filename, image_embedding in zip(cv_images, image_embeddings):
+                embeddings[filename] = image_embedding
+                if self.embedding_store is not None:
+                    self.embedding_store.put(filename, image_embedding)
+        return [embeddings.get(filename) for filename in filenames]
+
+    def get_preloaded_size(self):
+        """Get the number of next files to preload, so that the preloaded
+        embeddings fit in the memory budget of the cache"""
+        embedding_nbytes = self.image_embedding_cache.average_nbytes()
+        if not embedding_nbytes:
+            # Size of embeddings is not known before the first encoding
+            return 1
+        num_embeddings = int(
+            self.image_embedding_cache.max_bytes // embedding_nbytes
+        )
+        return max(1, num_embeddings - NUM_RESERVED_EMBEDDINGS)
+
     def set_auto_labeling_marks(self, marks):
         """Set auto labeling marks"""
         self.marks = marks
 
-    def post_process(self, masks):
+    @staticmethod
+    def create_shape(points, shape_type):
+        """
+        Create an auto labeling shape from an array of (x, y) points
+        """
+        shape = Shape(flags={})
+        shape.points = [QtCore.QPointF(x, y) for x, y in points.tolist()]
+        shape.shape_type = shape_type
+        shape.closed = True
+        shape.fill_color = "#000000"
+        shape.line_color = "#000000"
+        shape.line_width = 1
+        shape.label = "AUTOLABEL_OBJECT"
+        shape.selected = False
+        return shape
+
+    def post_process(self, masks, output_mode=None, offset=(0, 0)):
         """
-        Post process masks
+        Post process masks. offset is the (x, y) position of the masks
+        in the image, for masks cropped around an object.
         """
+        if output_mode is None:
+            output_mode = self.output_mode
+        if masks.size == 0:
+            return []
+
         # Find contours
-        masks[masks > 0.0] = 255
-        masks[masks <= 0.0] = 0
-        masks = masks.astype(np.uint8)
+        masks = (masks > 0.0).view(np.uint8)
         contours, _ = cv2.findContours(
-            masks, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
+            masks, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=offset
         )
 
         # Refine contours
-        approx_contours = []
-        for contour in contours:
-            # Approximate contour
-            epsilon = 0.001 * cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, epsilon, True)
-            approx_contours.append(approx)
-
-        # Remove too big contours ( >90% of image size)
-        if len(approx_contours) > 1:
-            image_size = masks.shape[0] * masks.shape[1]
-            areas = [cv2.contourArea(contour) for contour in approx_contours]
-            filtered_approx_contours = [
-                contour
-                for contour, area in zip(approx_contours, areas)
-                if area < image_size * 0.9
-            ]
+        approx_contours = [
+            cv2.approxPolyDP(
+                contour,
+                self.contour_approx_epsilon * cv2.arcLength(contour, True),
+                True,
+            )
+            for contour in contours
+        ]
 
         # Remove small contours (area < 20% of average area)
         if len(approx_contours) > 1:
-            areas = [cv2.contourArea(contour) for contour in approx_contours]
+            areas = np.array(
+                [cv2.contourArea(contour) for contour in approx_contours]
+            )
             avg_area = np.mean(areas)
-
-            filtered_approx_contours = [
+            approx_contours = [
                 contour
                 for contour, area in zip(approx_contours, areas)
                 if area > avg_area * 0.2
             ]
-            approx_contours = filtered_approx_contours
 
         # Contours to shapes
+        approx_contours = [
+            contour.reshape(-1, 2)
+            for contour in approx_contours
+            if len(contour) >= 3
+        ]
         shapes = []
-        if self.output_mode == "polygon":
-            for approx in approx_contours:
-                # Scale points
-                points = approx.reshape(-1, 2)
-                points[:, 0] = points[:, 0]
-                points[:, 1] = points[:, 1]
-                points = points.tolist()
-                if len(points) < 3:
-                    continue
-                points.append(points[0])
-
-                # Create shape
-                shape = Shape(flags={})
-                for point in points:
-                    point[0] = int(point[0])
-                    point[1] = int(point[1])
-                    shape.add_point(QtCore.QPointF(point[0], point[1]))
-                shape.shape_type = "polygon"
-                shape.closed = True
-                shape.fill_color = "#000000"
-                shape.line_color = "#000000"
-                shape.line_width = 1
-                shape.label = "AUTOLABEL_OBJECT"
-                shape.selected = False
-                shapes.append(shape)
-        elif self.output_mode == "rectangle":
-            x_min = 100000000
-            y_min = 100000000
-            x_max = 0
-            y_max = 0
-            for approx in approx_contours:
-                # Scale points
-                points = approx.reshape(-1, 2)
-                points[:, 0] = points[:, 0]
-                points[:, 1] = points[:, 1]
-                points = points.tolist()
-                if len(points) < 3:
-                    continue
-
-                # Get min/max
-                for point in points:
-                    x_min = min(x_min, point[0])
-                    y_min = min(y_min, point[1])
-                    x_max = max(x_max, point[0])
-                    y_max = max(y_max, point[1])
-
-            # Create shape
-            shape = Shape(flags={})
-            shape.add_point(QtCore.QPointF(x_min, y_min))
-            shape.add_point(QtCore.QPointF(x_max, y_max))
-            shape.shape_type = "rectangle"
-            shape.closed = True
-            shape.fill_color = "#000000"
-            shape.line_color = "#000000"
-            shape.line_width = 1
-            shape.label = "AUTOLABEL_OBJECT"
-            shape.selected = False
-            shapes.append(shape)
+        if output_mode == "polygon":
+            for points in approx_contours:
+                # A point on the first point closes the polygon,
+                # like when it is drawn point by point
+                keep = np.any(points != points[0], axis=1)
+                keep[0] = True
+                shapes.append(self.create_shape(points[keep], "polygon"))
+        elif output_mode == "rectangle" and approx_contours:
+            x, y, w, h = cv2.boundingRect(np.concatenate(approx_contours))
+            points = np.array([[x, y], [x + w - 1, y + h - 1]])
+            shapes.append(self.create_shape(points, "rectangle"))
 
         return shapes
 
@@ -224,32 +336,79 @@ class SegmentAnything(Model):
         """
         Predict shapes from image
         """
-        if image is None or not self.marks:
+        if image is None:
+            return AutoLabelingResult([], replace=False)
+        if self.output_mode == "everything":
+            return self.predict_everything(image, filename)
+        if not self.marks:
             return AutoLabelingResult([], replace=False)
 
         shapes = []
         try:
             # Use cached image embedding if possible
-            cached_data = self.image_embedding_cache.get(filename)
-            if cached_data is not None:
-                image_embedding = cached_data
-            else:
-                cv_image = qt_img_to_rgb_cv_img(image, filename)
+            image_embedding = self.get_image_embedding(filename, image)
+            if image_embedding is None or self.stop_inference:
+                return AutoLabelingResult([], replace=False)
+            # Upscale only the region of the object for large images
+            mask, offset = self.model.predict_mask_rois(
+                image_embedding, [self.marks]
+            )[0]
+            shapes = self.post_process(mask, offset=offset)
+        except Exception as e:  # noqa
+            logging.warning("Could not inference model")
+            logging.warning(e)
+            traceback.print_exc()
+            return AutoLabelingResult([], replace=False)
+
+        result = AutoLabelingResult(shapes, replace=False)
+        return result
+
+    def predict_everything(self, image, filename=None) -> AutoLabelingResult:
+        """
+        Predict shapes of all objects in an image, from a grid of points
+        decoded against the (cached) image embedding
+        """
+        shapes = []
+        try:
+            image_embedding = self.get_image_embedding(filename, image)
+            if image_embedding is None:
+                return AutoLabelingResult([], replace=False)
+            for mask, offset in self.mask_generator.generate(image_embedding):
                 if self.stop_inference:
                     return AutoLabelingResult([], replace=False)
-                image_embedding = self.model.encode(cv_image)
-                self.image_embedding_cache.put(
-                    filename,
-                    image_embedding,
+                shapes.extend(
+                    self.post_process(
+                        mask, output_mode="polygon", offset=offset
+                    )
                 )
-            if self.stop_inference:
+        except Exception as e:  # noqa
+            logging.warning("Could not inference model")
+            logging.warning(e)
+            traceback.print_exc()
+            return AutoLabelingResult([], replace=False)
+
+        result = AutoLabelingResult(shapes, replace=False)
+        return result
+
+    def predict_shapes_from_prompts(
+        self, image, prompts, filename=None
+    ) -> AutoLabelingResult:
+        """
+        Predict shapes for several independent prompts at once, e.g. boxes
+        imported from a detection file. Each prompt is a list of marks,
+        like the auto labeling marks, and gives its own object.
+        """
+        if image is None or not prompts:
+            return AutoLabelingResult([], replace=False)
+
+        shapes = []
+        try:
+            image_embedding = self.get_image_embedding(filename, image)
+            if image_embedding is None or self.stop_inference:
                 return AutoLabelingResult([], replace=False)
-            masks = self.model.predict_masks(image_embedding, self.marks)
-            if len(masks.shape) == 4:
-                masks = masks[0][0]
-            else:
-                masks = masks[0]
-            shapes = self.post_process(masks)
+            masks = self.model.predict_mask_rois(image_embedding, prompts)
+            for mask, offset in masks:
+                shapes.extend(self.post_process(mask, offset=offset))
         except Exception as e:  # noqa
             logging.warning("Could not inference model")
             logging.warning(e)
@@ -261,47 +420,62 @@ class SegmentAnything(Model):
 
     def unload(self):
         self.stop_inference = True
-        if self.pre_inference_thread:
-            self.pre_inference_thread.quit()
+        self.preload_scheduler.stop()
 
-    def preload_worker(self, files):
+    def deactivate(self):
+        self.preload_scheduler.cancel()
+
+    def get_memory_usage(self):
+        # Model files and the full embedding cache
+        return super().get_memory_usage() + self.cache_memory_mb * 1024 * 1024
+
+    def preload_files(self, filenames, priorities):
         """
-        Preload next files, run inference and cache results
+        Preload files, run inference and cache results
         """
-        files = files[: self.preloaded_size]
-        for filename in files:
-            if self.image_embedding_cache.find(filename):
-                continue
-            image = self.load_image_from_filename(filename)
-            if image is None:
-                continue
-            if self.stop_inference:
-                return
-            cv_image = qt_img_to_rgb_cv_img(image)
-            image_embedding = self.model.encode(cv_image)
-            self.image_embedding_cache.put(
-                filename,
-                image_embedding,
-            )
+        if self.stop_inference or not filenames:
+            return
+        filenames = list(filenames)
+        priorities = list(priorities)
+
+        # The current file is encoded alone to be available as soon as
+        # possible. So is the first file while the embedding size is not
+        # known, as the preloading window depends on it.
+        if (
+            priorities[0] == 0
+            or not self.image_embedding_cache.average_nbytes()
+        ):
+            self.get_image_embedding(filenames.pop(0))
+            priorities.pop(0)
+
+        # The window is checked after the first encoding, so that the
+        # next files are not dropped on a cold cache
+        preloaded_size = self.get_preloaded_size()
+        skipped = [
+            filename
+            for filename, priority in zip(filenames, priorities)
+            if priority >= preloaded_size
+        ]
+        if skipped:
+            logging.debug("Not preloading files out of window: %s", skipped)
+        filenames = [
+            filename
+            for filename, priority in zip(filenames, priorities)
+            if priority < preloaded_size
+        ]
+        if self.stop_inference or not filenames:
+            return
+
+        # The following files are encoded together
+        self.image_embedding_cache.compute_many(
+            filenames, self.load_or_encode_many
+        )
 
     def on_next_files_changed(self, next_files):
         """
         Handle next files changed. This function can preload next files
         and run inference to save time for user.
+        Files are preloaded in the order of the list, pending files of
+        the previous list are dropped.
         """
-        if (
-            self.pre_inference_thread is None
-            or not self.pre_inference_thread.isRunning()
-        ):
-            self.pre_inference_thread = QThread()
-            self.pre_inference_worker = GenericWorker(
-                self.preload_worker, next_files
-            )
-            self.pre_inference_worker.finished.connect(
-                self.pre_inference_thread.quit
-            )
-            self.pre_inference_worker.moveToThread(self.pre_inference_thread)
-            self.pre_inference_thread.started.connect(
-                self.pre_inference_worker.run
-            )
-            self.pre_inference_thread.start()
+        self.preload_scheduler.schedule(next_files)
@@ -0,0 +1,278 @@
+import logging
+
+import cv2
+import numpy as np
+import onnxruntime
+from PyQt5 import QtCore
+from PyQt5.QtCore import QCoreApplication
+
+from anylabeling.app_info import __preferred_device__
+from anylabeling.views.labeling.shape import Shape
+from anylabeling.views.labeling.utils.opencv import qt_img_to_rgb_cv_img
+from .model import Model
+from .onnx_session import create_inference_session
+from .types import AutoLabelingResult
+from .yolo_utils import get_output_boxes, non_max_suppression, scale_boxes
+
+BACKEND_OPENCV = "opencv"
+BACKEND_ONNXRUNTIME = "onnxruntime"
+
+# A single NMS over all classes, like cv2.dnn.NMSBoxes in earlier versions
+DEFAULT_AGNOSTIC_NMS = True
+
+DEFAULT_TILE_OVERLAP = 0.2
+DEFAULT_TILE_BATCH_SIZE = 4
+
+
+class YOLO(Model):
+    """Base class of YOLO object detection models.
+
+    The network runs on OpenCV DNN or ONNX Runtime, selected by the
+    "backend" option of the model config. Subclasses decode the raw
+    network output in `decode_outputs()`. Overlapping boxes are
+    suppressed whatever their class, unless "agnostic_nms" is false.
+
+    If "tile_size" is set in the model config, images larger than a tile
+    are also run as overlapping tiles of tile_size pixels, so that small
+    objects keep their resolution. Tiles overlap by "tile_overlap" (a
+    fraction of tile_size) and go through the network in batches of
+    "tile_batch_size", together with the whole image. Detections of all
+    tiles are merged by a single NMS in image coordinates.
+    """
+
+    class Meta:
+        required_config_names = [
+            "type",
+            "name",
+            "display_name",
+            "model_path",
+            "input_width",
+            "input_height",
+            "score_threshold",
+            "nms_threshold",
+            "confidence_threshold",
+            "classes",
+        ]
+        widgets = ["button_run"]
+        output_modes = {
+            "rectangle": QCoreApplication.translate("Model", "Rectangle"),
+        }
+        default_output_mode = "rectangle"
+
+    def __init__(self, model_config, on_message) -> None:
+        # Run the parent class's init method
+        super().__init__(model_config, on_message)
+        self.backend = self.config.get("backend", BACKEND_OPENCV)
+        if self.backend not in (BACKEND_OPENCV, BACKEND_ONNXRUNTIME):
+            raise ValueError(
+                QCoreApplication.translate(
+                    "Model", "Unknown backend: {backend}"
+                ).format(backend=self.backend)
+            )
+        self.net = None
+        self.session = None
+        self.fixed_batch_size = None
+        self.classes = self.config["classes"]
+
+    def load_network(self, model_abs_path):
+        """Load the network on the configured backend"""
+        if self.backend == BACKEND_ONNXRUNTIME:
+            if __preferred_device__ == "GPU":
+                providers = onnxruntime.get_available_providers()
+            else:
+                providers = ["CPUExecutionProvider"]
+            self.session = create_inference_session(
+                model_abs_path,
+                self.get_session_options(),
+                providers=providers,
+                cache_optimized_model=self.config.get(
+                    "cache_optimized_model", True
+                ),
+            )
+            self.input_name = self.session.get_inputs()[0].name
+            # Models exported with a fixed batch size only take that size
+            batch_size = self.session.get_inputs()[0].shape[0]
+            self.fixed_batch_size = (
+                batch_size if isinstance(batch_size, int) else None
+            )
+        else:
+            self.net = cv2.dnn.readNet(model_abs_path)
+            if __preferred_device__ == "GPU":
+                self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+                self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+
+    def pre_process(self, input_images):
+        """
+        Pre-process the input images before feeding them to the network.
+        """
+        # Create a 4D blob from a list of frames.
+        return cv2.dnn.blobFromImages(
+            input_images,
+            1 / 255,
+            (self.config["input_width"], self.config["input_height"]),
+            [0, 0, 0],
+            1,
+            crop=False,
+        )
+
+    def forward(self, blob):
+        """Run the network and return its first output,
+        with a leading batch axis"""
+        if self.session is not None:
+            return self.session.run(None, {self.input_name: blob})[0]
+
+        # Sets the input to the network.
+        self.net.setInput(blob)
+
+        # Runs the forward pass to get output of the output layers.
+        output_layers = self.net.getUnconnectedOutLayersNames()
+        return self.net.forward(output_layers)[0]
+
+    def decode_outputs(self, outputs):
+        """Select detections of the network output of one image.
+        Returns (cx, cy, w, h) boxes at network input size,
+        confidences and class ids."""
+        raise NotImplementedError()
+
+    def get_image_boxes(self, outputs, image_size, offset=(0, 0)):
+        """Decode the network output of one image or tile of
+        image_size (width, height) into (left, top, width, height) boxes
+        in image coordinates, shifted by offset"""
+        image_width, image_height = image_size
+
+        # Resizing factor.
+        x_factor = image_width / self.config["input_width"]
+        y_factor = image_height / self.config["input_height"]
+
+        boxes, confidences, class_ids = self.decode_outputs(outputs)
+        boxes = scale_boxes(boxes, x_factor, y_factor)
+        boxes[:, :2] += offset
+        return boxes, confidences, class_ids
+
+    def post_process(self, boxes, confidences, class_ids):
+        """
+        Post-process the decoded boxes, to get the bounding boxes and
+        their confidence scores.
+        """
+        # Perform non maximum suppression to eliminate redundant
+        # overlapping boxes with lower confidences.
+        indices = non_max_suppression(
+            boxes,
+            confidences,
+            class_ids,
+            self.config["confidence_threshold"],
+            self.config["nms_threshold"],
+            agnostic=self.config.get("agnostic_nms", DEFAULT_AGNOSTIC_NMS),
+        )
+
+        return get_output_boxes(
+            boxes, confidences, class_ids, indices, self.classes
+        )
+
+    def get_tiles(self, image):
+        """Get (x, y, width, height) of overlapping tiles covering
+        the image"""
+        tile_size = self.config["tile_size"]
+        overlap = self.config.get("tile_overlap", DEFAULT_TILE_OVERLAP)
+        stride = max(1, int(tile_size * (1 - overlap)))
+        image_height, image_width = image.shape[:2]
+
+        def get_starts(length):
+            if length <= tile_size:
+                return [0]
+            starts = list(range(0, length - tile_size, stride))
+            return starts + [length - tile_size]
+
+        return [
+            (x, y, min(tile_size, image_width), min(tile_size, image_height))
+            for y in get_starts(image_height)
+            for x in get_starts(image_width)
+        ]
+
+    def get_batch_size(self):
+        """Get the number of images per forward pass"""
+        if self.fixed_batch_size is not None:
+            return self.fixed_batch_size
+        return max(
+            1, self.config.get("tile_batch_size", DEFAULT_TILE_BATCH_SIZE)
+        )
+
+    def detect(self, image):
+        """Detect objects in an image, tile by tile if tile_size is set
+        and the image is larger than a tile"""
+        image_height, image_width = image.shape[:2]
+        regions = [(0, 0, image_width, image_height)]
+        tile_size = self.config.get("tile_size")
+        if tile_size and max(image_width, image_height) > tile_size:
+            regions += self.get_tiles(image)
+
+        results = []
+        start = 0
+        while start < len(regions):
+            batch = regions[start : start + self.get_batch_size()]
+            images = [image[y : y + h, x : x + w] for x, y, w, h in batch]
+            # Pad the last batch of models with a fixed batch size
+            images += [images[-1]] * (
+                (self.fixed_batch_size or len(images)) - len(images)
+            )
+            try:
+                outputs = self.forward(self.pre_process(images))
+            except cv2.error as e:
+                if self.net is None or len(images) == 1:
+                    raise
+                # OpenCV cannot run batches of this network
+                logging.warning("Could not run a batch of images: %s", e)
+                self.fixed_batch_size = 1
+                continue
+            if len(outputs) < len(batch):
+                if len(images) == 1:
+                    raise RuntimeError("The network returned no output")
+                # e.g. a network with a fixed batch size which folds the
+                # batch: tiles would be lost
+                logging.warning(
+                    "The network returned %d outputs for %d images, "
+                    "running images one by one",
+                    len(outputs),
+                    len(images),
+                )
+                self.fixed_batch_size = 1
+                continue
+            for (x, y, w, h), output in zip(batch, outputs):
+                results.append(self.get_image_boxes(output, (w, h), (x, y)))
+            start += len(batch)
+
+        boxes, confidences, class_ids = (
+            np.concatenate(values) for values in zip(*results)
+        )
+        return self.post_process(boxes, confidences, class_ids)
+
+    def predict_shapes(self, image, image_path=None):
+        """
+        Predict shapes from image
+        """
+
+        if image is None:
+            return []
+
+        try:
+            image = qt_img_to_rgb_cv_img(image, image_path)
+        except Exception as e:  # noqa
+            logging.warning("Could not inference model")
+            logging.warning(e)
+            return []
+
+        boxes = self.detect(image)
+        shapes = []
+
+        for box in boxes:
+            shape = Shape(label=box["label"], shape_type="rectangle", flags={})
+            shape.add_point(QtCore.QPointF(box["x1"], box["y1"]))
+            shape.add_point(QtCore.QPointF(box["x2"], box["y2"]))
+            shapes.append(shape)
+
+        result = AutoLabelingResult(shapes, replace=True)
+        return result
+
+    def unload(self):
+        self.net = None
+        self.session = None
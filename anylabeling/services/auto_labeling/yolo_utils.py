@@ -0,0 +1,107 @@
+"""Vectorized decoding of YOLOv5 / YOLOv8 network outputs."""
+import cv2
+import numpy as np
+
+
+def decode_yolov5_outputs(outputs, confidence_threshold, score_threshold):
+    """Select detections of a YOLOv5 output
+
+    Args:
+        outputs (np.ndarray): Rows of (cx, cy, w, h, objectness,
+            class scores...), shape (num_rows, 5 + num_classes).
+        confidence_threshold (float): Min objectness.
+        score_threshold (float): Min score of the best class (exclusive).
+
+    Returns:
+        tuple: (cx, cy, w, h) boxes, confidences and class ids
+            of the selected detections.
+    """
+    outputs = outputs[outputs[:, 4] >= confidence_threshold]
+    class_ids = np.argmax(outputs[:, 5:], axis=1)
+    class_scores = outputs[np.arange(len(outputs)), 5 + class_ids]
+    outputs = outputs[class_scores > score_threshold]
+    class_ids = class_ids[class_scores > score_threshold]
+    return outputs[:, :4], outputs[:, 4], class_ids
+
+
+def decode_yolov8_outputs(outputs, confidence_threshold):
+    """Select detections of a YOLOv8 output
+
+    Args:
+        outputs (np.ndarray): Rows of (cx, cy, w, h, class scores...),
+            shape (num_rows, 4 + num_classes).
+        confidence_threshold (float): Min score of the best class.
+
+    Returns:
+        tuple: (cx, cy, w, h) boxes, confidences and class ids
+            of the selected detections.
+    """
+    class_ids = np.argmax(outputs[:, 4:], axis=1)
+    confidences = outputs[np.arange(len(outputs)), 4 + class_ids]
+    keep = confidences >= confidence_threshold
+    return outputs[keep, :4], confidences[keep], class_ids[keep]
+
+
+def scale_boxes(boxes, x_factor, y_factor):
+    """Convert (cx, cy, w, h) boxes at network input size into integer
+    (left, top, width, height) boxes at image size"""
+    # Computed in float64 and truncated like Python int()
+    boxes = boxes.astype(np.float64)
+    cx, cy, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    return np.stack(
+        [
+            (cx - w / 2) * x_factor,
+            (cy - h / 2) * y_factor,
+            w * x_factor,
+            h * y_factor,
+        ],
+        axis=1,
+    ).astype(np.int64)
+
+
+def non_max_suppression(
+    boxes,
+    confidences,
+    class_ids,
+    confidence_threshold,
+    nms_threshold,
+    agnostic=True,
+):
+    """Run a single non maximum suppression over all boxes.
+    If agnostic is False, boxes of different classes never suppress each
+    other: they are shifted apart by class before NMS.
+    Returns the indices of kept boxes, by decreasing confidence."""
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if not agnostic:
+        offset = (
+            boxes[:, :2].max() - boxes[:, :2].min() + boxes[:, 2:].max() + 1
+        )
+        boxes = boxes.copy()
+        boxes[:, :2] += class_ids[:, None] * offset
+    indices = cv2.dnn.NMSBoxes(
+        boxes.tolist(),
+        confidences.astype(np.float32).tolist(),
+        confidence_threshold,
+        nms_threshold,
+    )
+    return np.array(indices, dtype=np.int64).reshape(-1)
+
+
+def get_output_boxes(boxes, confidences, class_ids, indices, classes):
+    """Build output boxes of kept detections"""
+    return [
+        {
+            "x1": left,
+            "y1": top,
+            "x2": left + width,
+            "y2": top + height,
+            "label": classes[class_id],
+            "score": score,
+        }
+        for (left, top, width, height), score, class_id in zip(
+            boxes[indices].tolist(),
+            confidences[indices].tolist(),
+            class_ids[indices].tolist(),
+        )
+    ]
@@ -1,17 +1,48 @@
 import base64
 import contextlib
+import functools
 import io
 import json
+import os
 import os.path as osp
+import re
 
+import numpy as np
 import PIL.Image
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from ...app_info import __version__
 from . import utils
 from .logger import logger
 
 PIL.Image.MAX_IMAGE_PIXELS = None
 
+# Image modes which can be saved as PNG
+PNG_MODES = ["1", "L", "LA", "I", "I;16", "P", "RGB", "RGBA"]
+
+# Label files from this size are parsed by streaming with ijson, if
+# installed, without reading their embedded image
+STREAMING_MIN_FILE_SIZE = 16 * 1024 * 1024
+
+# Tokens of JSON documents, outside and inside strings
+JSON_STRUCTURE_TOKENS = re.compile(rb'["{}\[\],]')
+JSON_STRING_TOKENS = re.compile(rb'["\\]')
+
+# Whether reading a large label file without ijson was logged
+_logged_streaming_unavailable = False
+
+# Decimals of point coordinates in compact label files
+COMPACT_PRECISION = 2
+
 
 @contextlib.contextmanager
 def io_open(name, mode):
@@ -24,17 +55,186 @@ class LabelFileError(Exception):
     pass
 
 
+class StdlibJSONCodec:
+    """JSON codec of the standard library"""
+
+    name = "json"
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(data, indent=None):
+        separators = None if indent else (",", ":")
+        return json.dumps(
+            data, ensure_ascii=False, indent=indent, separators=separators
+        ).encode("utf-8")
+
+
+class OrjsonCodec:
+    """JSON codec of orjson, several times faster than the standard
+    library. Only an indent of 2 is supported."""
+
+    name = "orjson"
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+    @staticmethod
+    def dumps(data, indent=None):
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(data, option=option)
+        except TypeError:
+            # e.g. non-string keys, which the standard library converts
+            return StdlibJSONCodec.dumps(data, indent=indent)
+
+
+def round_points(shapes, precision=COMPACT_PRECISION):
+    """Get shapes with their point coordinates rounded"""
+    return [
+        dict(
+            shape,
+            points=np.round(
+                np.asarray(shape["points"], dtype=np.float64), precision
+            ).tolist(),
+        )
+        for shape in shapes
+    ]
+
+
+class _SkipImageDataReader:
+    """Binary file reader which replaces the "imageData" string of a label
+    file by true, so that a streaming parser skips the embedded image
+    without building it. The rest of the file is read unchanged."""
+
+    def __init__(self, f):
+        self._f = f
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._expect_key = False
+        # Top-level key being read, and last top-level key read
+        self._key = None
+        self._last_key = None
+        self._skipping = False
+        self._done = False
+
+    def read(self, size=-1):
+        while True:
+            data = self._f.read(size)
+            if not data or self._done:
+                return data
+            # Data only made of the embedded image is not returned, since
+            # an empty result means the end of the file
+            data = self._filter(data)
+            if data:
+                return data
+
+    def _filter(self, data):
+        output = []
+        start = 0  # Start of the data to output
+        pos = 0
+        while pos < len(data) and not self._done:
+            if self._escaped:
+                self._escaped = False
+                pos += 1
+            elif self._in_string:
+                match = JSON_STRING_TOKENS.search(data, pos)
+                end = match.start() if match else len(data)
+                if self._key is not None:
+                    self._key += data[pos:end]
+                if match is None:
+                    break
+                pos = match.end()
+                if match.group() == b"\\":
+                    self._escaped = True
+                    if self._key is not None:
+                        self._key += b"\\"
+                    continue
+                self._in_string = False
+                if self._skipping:
+                    self._skipping = False
+                    self._done = True
+                    start = pos
+                elif self._key is not None:
+                    self._last_key, self._key = self._key, None
+            else:
+                match = JSON_STRUCTURE_TOKENS.search(data, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                token = match.group()
+                if token == b'"':
+                    self._in_string = True
+                    if self._depth == 1 and self._expect_key:
+                        self._expect_key = False
+                        self._key = b""
+                    elif self._depth == 1 and self._last_key == b"imageData":
+                        output.append(data[start : match.start()])
+                        output.append(b"true")
+                        self._skipping = True
+                elif token in b"{[":
+                    self._depth += 1
+                    self._expect_key = self._depth == 1
+                elif token in b"}]":
+                    self._depth -= 1
+                elif self._depth == 1:
+                    self._expect_key = True
+        if not self._skipping:
+            output.append(data[start:])
+        return b"".join(output)
+
+
 class LabelFile:
+    """Label file of an image.
+
+    Loading a label file reads its shapes, flags and image dimensions
+    without decoding the image: `image_data` is decoded from the embedded
+    base64 data, or read from the image file, on first access.
+    """
+
     suffix = ".json"
+    # Codec of label files, the fastest installed one by default
+    codec = OrjsonCodec if orjson is not None else StdlibJSONCodec
 
     def __init__(self, filename=None):
         self.shapes = []
         self.image_path = None
-        self.image_data = None
+        self.image_height = None
+        self.image_width = None
+        self.has_embedded_image = False
+        self._image_data = None
+        self._image_data_loader = None
         if filename is not None:
             self.load(filename)
         self.filename = filename
 
+    @property
+    def image_data(self):
+        """Image bytes, loaded on first access"""
+        if self._image_data_loader is not None:
+            try:
+                image_data = self._image_data_loader()
+                if image_data is not None:
+                    self._check_image_height_and_width(
+                        image_data, self.image_height, self.image_width
+                    )
+            except Exception as e:  # noqa
+                raise LabelFileError(e) from e
+            self._image_data = image_data
+            self._image_data_loader = None
+        return self._image_data
+
+    @image_data.setter
+    def image_data(self, image_data):
+        self._image_data = image_data
+        self._image_data_loader = None
+
     @staticmethod
     def load_image_file(filename):
         try:
@@ -43,19 +243,24 @@ class LabelFile:
             logger.error("Failed opening image file: %s", filename)
             return None
 
-        # apply orientation to image according to exif
-        image_pil = utils.apply_exif_orientation(image_pil)
-
-        with io.BytesIO() as f:
-            ext = osp.splitext(filename)[1].lower()
-            if ext in [".jpg", ".jpeg"]:
-                image_pil = image_pil.convert("RGB")
-                img_format = "JPEG"
+        with image_pil:
+            # apply orientation to image according to exif. The original
+            # bytes are returned, without decoding the image, unless the
+            # orientation has to be applied
+            if utils.get_exif_orientation(image_pil) not in [None, 1]:
+                oriented_image_pil = utils.apply_exif_orientation(image_pil)
             else:
-                img_format = "PNG"
-            image_pil.save(f, format=img_format)
-            f.seek(0)
-            return f.read()
+                oriented_image_pil = image_pil
+            if oriented_image_pil is image_pil:
+                with open(filename, "rb") as f:
+                    return f.read()
+
+            # Lossless and fast re-encoding of the rotated image
+            if oriented_image_pil.mode not in PNG_MODES:
+                oriented_image_pil = oriented_image_pil.convert("RGB")
+            with io.BytesIO() as f:
+                oriented_image_pil.save(f, format="PNG", compress_level=1)
+                return f.getvalue()
 
     def load(self, filename):
         keys = [
@@ -76,27 +281,30 @@ class LabelFile:
             "flags",
         ]
         try:
-            with io_open(filename, "r") as f:
-                data = json.load(f)
+            data, streamed = self._read_json(filename)
             version = data.get("version")
             if version is None:
                 logger.warning(
                     "Loading JSON file (%s) of unknown version", filename
                 )
 
-            if data["imageData"] is not None:
-                image_data = base64.b64decode(data["imageData"])
+            has_embedded_image = data["imageData"] is not None
+            if streamed and has_embedded_image:
+                image_data_loader = functools.partial(
+                    self._read_embedded_image_data, filename
+                )
+            elif has_embedded_image:
+                image_data_loader = functools.partial(
+                    base64.b64decode, data["imageData"]
+                )
             else:
                 # relative path from label file to relative path from cwd
                 image_path = osp.join(osp.dirname(filename), data["imagePath"])
-                image_data = self.load_image_file(image_path)
+                image_data_loader = functools.partial(
+                    self.load_image_file, image_path
+                )
             flags = data.get("flags") or {}
             image_path = data["imagePath"]
-            self._check_image_height_and_width(
-                base64.b64encode(image_data).decode("utf-8"),
-                data.get("imageHeight"),
-                data.get("imageWidth"),
-            )
             shapes = [
                 {
                     "label": s["label"],
@@ -126,25 +334,60 @@ class LabelFile:
         self.flags = flags
         self.shapes = shapes
         self.image_path = image_path
-        self.image_data = image_data
+        self.image_height = data.get("imageHeight")
+        self.image_width = data.get("imageWidth")
+        self.has_embedded_image = has_embedded_image
+        self._image_data = None
+        self._image_data_loader = image_data_loader
         self.filename = filename
         self.other_data = other_data
 
+    @classmethod
+    def _read_json(cls, filename):
+        """Read the JSON data of a label file. Returns the data and
+        whether it was streamed: large files are parsed with ijson, if
+        installed, and the embedded image data is then replaced by True"""
+        global _logged_streaming_unavailable
+        streamed = osp.getsize(filename) >= STREAMING_MIN_FILE_SIZE
+        if streamed and ijson is None and not _logged_streaming_unavailable:
+            logger.info(
+                "ijson is not installed, label files of %d MB or more are "
+                "read in memory. Install it with: pip install ijson",
+                STREAMING_MIN_FILE_SIZE // (1024 * 1024),
+            )
+            _logged_streaming_unavailable = True
+        if not streamed or ijson is None:
+            with open(filename, "rb") as f:
+                return cls.codec.loads(f.read()), False
+
+        with open(filename, "rb") as f:
+            reader = _SkipImageDataReader(f)
+            return dict(ijson.kvitems(reader, "", use_float=True)), True
+
+    @staticmethod
+    def _read_embedded_image_data(filename):
+        """Read the embedded image data of a streamed label file"""
+        with open(filename, "rb") as f:
+            for image_data in ijson.items(f, "imageData"):
+                return base64.b64decode(image_data)
+        return None
+
     @staticmethod
     def _check_image_height_and_width(image_data, image_height, image_width):
-        img_arr = utils.img_b64_to_arr(image_data)
-        if image_height is not None and img_arr.shape[0] != image_height:
+        # Only the image header is read, pixels are not decoded
+        actual_width, actual_height = utils.img_data_to_size(image_data)
+        if image_height is not None and actual_height != image_height:
             logger.error(
                 "image_height does not match with image_data or image_path, "
                 "so getting image_height from actual image."
             )
-            image_height = img_arr.shape[0]
-        if image_width is not None and img_arr.shape[1] != image_width:
+            image_height = actual_height
+        if image_width is not None and actual_width != image_width:
             logger.error(
                 "image_width does not match with image_data or image_path, "
                 "so getting image_width from actual image."
             )
-            image_width = img_arr.shape[1]
+            image_width = actual_width
         return image_height, image_width
 
     def save(
@@ -157,16 +400,22 @@ class LabelFile:
         image_data=None,
         other_data=None,
         flags=None,
+        compact=False,
     ):
+        """Save a label file. Compact label files are written without
+        indentation, with point coordinates rounded to
+        COMPACT_PRECISION decimals."""
         if image_data is not None:
-            image_data = base64.b64encode(image_data).decode("utf-8")
             image_height, image_width = self._check_image_height_and_width(
                 image_data, image_height, image_width
             )
+            image_data = base64.b64encode(image_data).decode("utf-8")
         if other_data is None:
             other_data = {}
         if flags is None:
             flags = {}
+        if compact and shapes is not None:
+            shapes = round_points(shapes)
         data = {
             "version": __version__,
             "flags": flags,
@@ -180,12 +429,28 @@ class LabelFile:
             assert key not in data
             data[key] = value
         try:
-            with io_open(filename, "w") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            content = self.codec.dumps(data, indent=None if compact else 2)
+            self._write_atomic(filename, content)
             self.filename = filename
         except Exception as e:  # noqa
             raise LabelFileError(e) from e
 
+    @staticmethod
+    def _write_atomic(filename, content):
+        """Write a file through a temporary file, so that the file is
+        never left truncated if writing is interrupted"""
+        temp_filename = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(temp_filename, "wb") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_filename, filename)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_filename)
+            raise
+
     @staticmethod
     def is_label_file(filename):
         return osp.splitext(filename)[1].lower() == LabelFile.suffix
@@ -0,0 +1,86 @@
+"""Background writer of label files."""
+import os.path as osp
+import threading
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from .label_file import LabelFile
+from .logger import logger
+
+
+class LabelFileWriter(QObject):
+    """Save label files on a background thread, so that encoding the
+    image data and the JSON does not block the UI.
+
+    Saves are queued by file: a save replaces a pending save of the same
+    file, so rapid successive saves write the file once, with the latest
+    content. Files are written atomically by `LabelFile.save()`.
+    `saved` is emitted with the file name when a file is written, and
+    `save_failed` with the file name and the error if a save fails.
+    """
+
+    saved = pyqtSignal(str)
+    save_failed = pyqtSignal(str, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._writing = None
+        self._thread = threading.Thread(
+            target=self._run, name="LabelFileWriter"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _get_key(filename):
+        return osp.normpath(osp.abspath(filename))
+
+    def save(self, filename, **kwargs):
+        """Queue saving a label file, with the arguments of
+        `LabelFile.save()`. Arguments must not be modified afterwards."""
+        with self._condition:
+            self._pending[self._get_key(filename)] = (filename, kwargs)
+            self._condition.notify_all()
+
+    def is_pending(self, filename=None):
+        """Returns True if a file, or any file if filename is None,
+        is waiting to be saved or being saved"""
+        with self._condition:
+            return self._is_pending(filename)
+
+    def flush(self, filename=None):
+        """Wait until a file, or all files if filename is None,
+        are saved"""
+        with self._condition:
+            self._condition.wait_for(lambda: not self._is_pending(filename))
+
+    def _is_pending(self, filename):
+        if filename is None:
+            return bool(self._pending) or self._writing is not None
+        key = self._get_key(filename)
+        return key in self._pending or key == self._writing
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                self._writing = next(iter(self._pending))
+                filename, kwargs = self._pending.pop(self._writing)
+
+            error = None
+            try:
+                LabelFile().save(filename=filename, **kwargs)
+            except Exception as e:  # noqa
+                logger.error("Error saving label file %s: %s", filename, e)
+                error = str(e)
+
+            with self._condition:
+                self._writing = None
+                self._condition.notify_all()
+            # Signals are sent once the file is no longer pending
+            if error is None:
+                self.saved.emit(filename)
+            else:
+                self.save_failed.emit(filename, error)
@@ -4,11 +4,12 @@ import math
 import os
 import os.path as osp
 import re
+import threading
 import webbrowser
 
 import darkdetect
 import imgviz
-import natsort
+import PIL.Image
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt, pyqtSlot
 from PyQt5.QtWidgets import (
@@ -27,8 +28,18 @@ from ...app_info import __appname__
 from . import utils
 from ...config import get_config, save_config
 from .label_file import LabelFile, LabelFileError
+from .label_file_writer import LabelFileWriter
 from .logger import logger
+from .project_index import (
+    STATUS_ALL,
+    STATUS_LABELED,
+    STATUS_UNLABELED,
+    ProjectIndex,
+    get_image_extensions,
+    get_label_file,
+)
 from .shape import Shape
+from .utils.image_cache import get_image_cache
 from .widgets import (
     AutoLabelingWidget,
     BrightnessContrastDialog,
@@ -54,6 +65,8 @@ class LabelingWidget(LabelDialog):
 
     FIT_WINDOW, FIT_WIDTH, MANUAL_ZOOM = 0, 1, 2
     next_files_changed = QtCore.pyqtSignal(list)
+    project_index_scanned = QtCore.pyqtSignal(object)
+    project_index_refreshed = QtCore.pyqtSignal(object)
 
     def __init__(
         self,
@@ -107,6 +120,16 @@ class LabelingWidget(LabelDialog):
         # Whether we need to save or not.
         self.dirty = False
 
+        # Label files are written on a background thread
+        self.label_file_writer = LabelFileWriter()
+        self.label_file_writer.saved.connect(self.on_label_file_saved)
+        self.label_file_writer.save_failed.connect(
+            self.on_label_file_save_failed
+        )
+        QtWidgets.QApplication.instance().aboutToQuit.connect(
+            self.label_file_writer.flush
+        )
+
         self._no_selection_slot = False
 
         self._copied_shapes = None
@@ -124,6 +147,11 @@ class LabelingWidget(LabelDialog):
 
         self.label_list = LabelListWidget()
         self.last_open_dir = None
+        # Index of the images and label files of the opened folder
+        self.project_index = None
+        self.open_after_scan = False
+        self.project_index_scanned.connect(self.on_project_index_scanned)
+        self.project_index_refreshed.connect(self.on_project_index_refreshed)
 
         if not darkdetect.isDark():
             dock_title_style = (
@@ -192,6 +220,23 @@ class LabelingWidget(LabelDialog):
         self.file_search = QtWidgets.QLineEdit()
         self.file_search.setPlaceholderText(self.tr("Search Filename"))
         self.file_search.textChanged.connect(self.file_search_changed)
+        self.file_status_filter = QtWidgets.QComboBox()
+        self.file_status_filter.addItem(self.tr("All Images"), STATUS_ALL)
+        self.file_status_filter.addItem(
+            self.tr("Labeled Images"), STATUS_LABELED
+        )
+        self.file_status_filter.addItem(
+            self.tr("Unlabeled Images"), STATUS_UNLABELED
+        )
+        self.file_status_filter.currentIndexChanged.connect(
+            self.file_search_changed
+        )
+        # Images with a label, from the labels of the indexed label files
+        self.file_label_filter = QtWidgets.QComboBox()
+        self.file_label_filter.addItem(self.tr("All Labels"), None)
+        self.file_label_filter.currentIndexChanged.connect(
+            self.file_search_changed
+        )
         self.file_list_widget = QtWidgets.QListWidget()
         self.file_list_widget.itemSelectionChanged.connect(
             self.file_selection_changed
@@ -200,6 +245,8 @@ class LabelingWidget(LabelDialog):
         file_list_layout.setContentsMargins(0, 0, 0, 0)
         file_list_layout.setSpacing(0)
         file_list_layout.addWidget(self.file_search)
+        file_list_layout.addWidget(self.file_status_filter)
+        file_list_layout.addWidget(self.file_label_filter)
         file_list_layout.addWidget(self.file_list_widget)
         self.file_dock = QtWidgets.QDockWidget(self.tr("Files"), self)
         self.file_dock.setObjectName("Files")
@@ -1019,6 +1066,8 @@ class LabelingWidget(LabelDialog):
 
         # Application state.
         self.image = QtGui.QImage()
+        # Decoded RGB pixels of the image, viewed by self.image
+        self.image_array = None
         self.image_path = None
         self.recent_files = []
         self.max_recent = 7
@@ -1161,10 +1210,7 @@ class LabelingWidget(LabelDialog):
         self.actions.undo.setEnabled(self.canvas.is_shape_restorable)
 
         if self._config["auto_save"] or self.actions.save_auto.isChecked():
-            label_file = osp.splitext(self.image_path)[0] + ".json"
-            if self.output_dir:
-                label_file_without_path = osp.basename(label_file)
-                label_file = osp.join(self.output_dir, label_file_without_path)
+            label_file = get_label_file(self.image_path, self.output_dir)
             self.save_labels(label_file)
             return
         self.dirty = True
@@ -1425,11 +1471,12 @@ class LabelingWidget(LabelDialog):
         self.set_dirty()
 
     def file_search_changed(self):
-        self.import_image_folder(
-            self.last_open_dir,
-            pattern=self.file_search.text(),
-            load=False,
-        )
+        # Filter the images of the opened folder from its index
+        if self.project_index is None or not self.may_continue():
+            return
+        self.filename = None
+        self.fill_file_list(pattern=self.file_search.text())
+        self.open_next_image(load=False)
 
     def file_selection_changed(self):
         items = self.file_list_widget.selectedItems()
@@ -1596,6 +1643,8 @@ class LabelingWidget(LabelDialog):
             self.flag_widget.addItem(item)
 
     def save_labels(self, filename):
+        """Snapshot the labels of the current image and queue writing
+        them to a label file on the background writer"""
         label_file = LabelFile()
 
         def format_shape(s):
@@ -1637,16 +1686,27 @@ class LabelingWidget(LabelDialog):
             )
             if osp.dirname(filename) and not osp.exists(osp.dirname(filename)):
                 os.makedirs(osp.dirname(filename))
-            label_file.save(
-                filename=filename,
+            self.label_file_writer.save(
+                filename,
                 shapes=shapes,
                 image_path=image_path,
                 image_data=image_data,
                 image_height=self.image.height(),
                 image_width=self.image.width(),
-                other_data=self.other_data,
+                other_data=dict(self.other_data),
                 flags=flags,
+                compact=self._config["compact_label_file"],
             )
+            if self.project_index is not None:
+                self.project_index.set_labels(
+                    self.image_path,
+                    filename,
+                    shapes,
+                    self.image.height(),
+                    self.image.width(),
+                )
+                self.update_file_label_filter()
+            label_file.filename = filename
             self.label_file = label_file
             items = self.file_list_widget.findItems(
                 self.image_path, Qt.MatchExactly
@@ -1658,12 +1718,31 @@ class LabelingWidget(LabelDialog):
             # disable allows next and previous image to proceed
             # self.filename = filename
             return True
-        except LabelFileError as e:
+        except (LabelFileError, OSError) as e:
             self.error_message(
                 self.tr("Error saving label data"), self.tr("<b>%s</b>") % e
             )
             return False
 
+    def on_label_file_saved(self, filename):
+        # Only the last queued labels of a file are written
+        if self.project_index is not None and (
+            not self.label_file_writer.is_pending(filename)
+        ):
+            self.project_index.set_label_file_saved(filename)
+
+    def on_label_file_save_failed(self, filename, error):
+        self.error_message(
+            self.tr("Error saving label data"), self.tr("<b>%s</b>") % error
+        )
+        # Keep the labels to be saved again
+        if (
+            self.label_file is not None
+            and self.label_file.filename == filename
+        ):
+            self.dirty = True
+            self.actions.save.setEnabled(True)
+
     def duplicate_selected_shape(self):
         added_shapes = self.canvas.duplicate_selected_shapes()
         self.label_list.clearSelection()
@@ -1844,9 +1923,16 @@ class LabelingWidget(LabelDialog):
             QtGui.QPixmap.fromImage(qimage), clear_shapes=False
         )
 
+    def get_image_pil(self):
+        """Get the current image as a PIL image,
+        sharing the decoded pixels if possible"""
+        if self.image_array is not None:
+            return PIL.Image.fromarray(self.image_array)
+        return utils.img_data_to_pil(self.image_data)
+
     def brightness_contrast(self, _):
         dialog = BrightnessContrastDialog(
-            utils.img_data_to_pil(self.image_data),
+            self.get_image_pil(),
             self.on_new_brightness_contrast,
             parent=self,
         )
@@ -1867,8 +1953,10 @@ class LabelingWidget(LabelDialog):
         for item in self.label_list:
             item.setCheckState(Qt.Checked if value else Qt.Unchecked)
 
-    def get_next_files(self, filename, num_files):
-        """Get the next files in the list."""
+    def get_neighbor_files(self, filename, num_files):
+        """Get the files around the current file in the list, sorted by
+        distance: the current file first, then the next and previous
+        files alternately."""
         if not self.image_list:
             return []
         filenames = []
@@ -1879,21 +1967,20 @@ class LabelingWidget(LabelDialog):
             except ValueError:
                 return []
             filenames.append(filename)
-        for _ in range(num_files):
-            if current_index + 1 < len(self.image_list):
-                filenames.append(self.image_list[current_index + 1])
-                current_index += 1
-            else:
-                filenames.append(self.image_list[-1])
-                break
+        for distance in range(1, num_files + 1):
+            for index in (current_index + distance, current_index - distance):
+                if 0 <= index < len(self.image_list):
+                    filenames.append(self.image_list[index])
         return filenames
 
     def inform_next_files(self, filename):
         """Inform the next files to be annotated.
         This list can be used by the user to preload the next files
-        or running a background process to process them
+        or running a background process to process them.
+        Files are sorted by priority, starting with the current file
+        and going on with its neighbors in both directions.
         """
-        next_files = self.get_next_files(filename, 5)
+        next_files = self.get_neighbor_files(filename, 5)
         if next_files:
             self.next_files_changed.emit(next_files)
 
@@ -1932,15 +2019,15 @@ class LabelingWidget(LabelDialog):
         self.status(
             str(self.tr("Loading %s...")) % osp.basename(str(filename))
         )
-        label_file = osp.splitext(filename)[0] + ".json"
-        if self.output_dir:
-            label_file_without_path = osp.basename(label_file)
-            label_file = osp.join(self.output_dir, label_file_without_path)
+        label_file = get_label_file(filename, self.output_dir)
+        # Wait for the label file if it is being saved
+        self.label_file_writer.flush(label_file)
         if QtCore.QFile.exists(label_file) and LabelFile.is_label_file(
             label_file
         ):
             try:
                 self.label_file = LabelFile(label_file)
+                self.image_data = self.label_file.image_data
             except LabelFileError as e:
                 self.error_message(
                     self.tr("Error opening file"),
@@ -1952,7 +2039,6 @@ class LabelingWidget(LabelDialog):
                 )
                 self.status(self.tr("Error reading %s") % label_file)
                 return False
-            self.image_data = self.label_file.image_data
             self.image_path = osp.join(
                 osp.dirname(label_file),
                 self.label_file.image_path,
@@ -1968,7 +2054,17 @@ class LabelingWidget(LabelDialog):
             if self.image_data:
                 self.image_path = filename
             self.label_file = None
-        image = QtGui.QImage.fromData(self.image_data)
+        # Decode the image once, for the canvas and the models
+        if self.label_file is not None and self.label_file.has_embedded_image:
+            image_array = get_image_cache().get_from_data(self.image_data)
+        elif self.label_file is not None:
+            image_array = get_image_cache().get(self.image_path)
+        else:
+            image_array = get_image_cache().get(filename)
+        if image_array is not None:
+            image = utils.rgb_array_to_qimage(image_array)
+        else:
+            image = QtGui.QImage.fromData(self.image_data or b"")
 
         if image.isNull():
             formats = [
@@ -1985,6 +2081,7 @@ class LabelingWidget(LabelDialog):
             self.status(self.tr("Error reading %s") % filename)
             return False
         self.image = image
+        self.image_array = image_array
         self.filename = filename
         if self._config["keep_prev"]:
             prev_shapes = self.canvas.shapes
@@ -2016,7 +2113,7 @@ class LabelingWidget(LabelDialog):
                 )
         # set brightness contrast values
         dialog = BrightnessContrastDialog(
-            utils.img_data_to_pil(self.image_data),
+            self.get_image_pil(),
             self.on_new_brightness_contrast,
             parent=self,
         )
@@ -2091,6 +2188,7 @@ class LabelingWidget(LabelDialog):
     def closeEvent(self, event):
         if not self.may_continue():
             event.ignore()
+        self.label_file_writer.flush()
         self.settings.setValue(
             "filename", self.filename if self.filename else ""
         )
@@ -2103,10 +2201,7 @@ class LabelingWidget(LabelDialog):
 
     # QT Overload
     def dragEnterEvent(self, event):
-        extensions = [
-            f".{fmt.data().decode().lower()}"
-            for fmt in QtGui.QImageReader.supportedImageFormats()
-        ]
+        extensions = get_image_extensions()
         if event.mimeData().hasUrls():
             items = [i.toLocalFile() for i in event.mimeData().urls()]
             if any(i.lower().endswith(tuple(extensions)) for i in items):
@@ -2328,9 +2423,13 @@ class LabelingWidget(LabelDialog):
             return
 
         label_file = self.get_label_file()
+        self.label_file_writer.flush(label_file)
         if osp.exists(label_file):
             os.remove(label_file)
             logger.info("Label file is removed: %s", label_file)
+            if self.project_index is not None:
+                self.project_index.remove_labels(self.filename)
+                self.update_file_label_filter()
 
             item = self.file_list_widget.currentItem()
             item.setCheckState(Qt.Unchecked)
@@ -2352,7 +2451,9 @@ class LabelingWidget(LabelDialog):
             return False
 
         label_file = self.get_label_file()
-        return osp.exists(label_file)
+        return osp.exists(label_file) or self.label_file_writer.is_pending(
+            label_file
+        )
 
     def may_continue(self):
         if not self.dirty:
@@ -2462,10 +2563,7 @@ class LabelingWidget(LabelDialog):
         return lst
 
     def import_dropped_image_files(self, image_files):
-        extensions = [
-            f".{fmt.data().decode().lower()}"
-            for fmt in QtGui.QImageReader.supportedImageFormats()
-        ]
+        extensions = get_image_extensions()
 
         self.filename = None
         for file in image_files:
@@ -2473,10 +2571,7 @@ class LabelingWidget(LabelDialog):
                 tuple(extensions)
             ):
                 continue
-            label_file = osp.splitext(file)[0] + ".json"
-            if self.output_dir:
-                label_file_without_path = osp.basename(label_file)
-                label_file = osp.join(self.output_dir, label_file_without_path)
+            label_file = get_label_file(file, self.output_dir)
             item = QtWidgets.QListWidgetItem(file)
             item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
             if QtCore.QFile.exists(label_file) and LabelFile.is_label_file(
@@ -2502,39 +2597,110 @@ class LabelingWidget(LabelDialog):
 
         self.last_open_dir = dirpath
         self.filename = None
+        self.open_project_index(dirpath)
+        self.fill_file_list(pattern=pattern)
+        # Images of the index may have been removed since the last scan:
+        # a removed first image is replaced once the folder is scanned
+        first_item = self.file_list_widget.item(0)
+        self.open_after_scan = (
+            load
+            and first_item is not None
+            and not osp.exists(first_item.text())
+        )
+        self.open_next_image(load=load and not self.open_after_scan)
+
+    def open_project_index(self, dirpath):
+        """Open the index of a folder. The file list is filled from the
+        index, then the folder is scanned for images and label files are
+        checked and read in the background. A folder without index is
+        scanned first."""
+        # Label files being saved must be found by the scan
+        self.label_file_writer.flush()
+        if self.project_index is not None:
+            self.project_index.close()
+        self.project_index = ProjectIndex(dirpath, self.output_dir)
+        self.file_label_filter.blockSignals(True)
+        self.file_label_filter.setCurrentIndex(0)
+        self.file_label_filter.blockSignals(False)
+        self.update_file_label_filter()
+        extensions = get_image_extensions()
+        if not self.project_index.get_images():
+            self.project_index.scan(extensions)
+        update_thread = threading.Thread(
+            target=self.update_project_index,
+            args=(self.project_index, extensions),
+            name="ProjectIndexUpdate",
+        )
+        update_thread.daemon = True
+        update_thread.start()
+
+    def update_project_index(self, project_index, extensions):
+        """Scan the folder of an index and read its modified label
+        files. Runs in the background."""
+        if project_index.scan(extensions):
+            self.project_index_scanned.emit(project_index)
+        project_index.refresh()
+        self.project_index_refreshed.emit(project_index)
+
+    def on_project_index_scanned(self, project_index):
+        """Update the file list with the images found by the scan,
+        keeping the current image selected"""
+        if project_index is not self.project_index:
+            return
+        self.file_list_widget.blockSignals(True)
+        self.fill_file_list(pattern=self.file_search.text())
+        items = self.file_list_widget.findItems(
+            self.filename or "", Qt.MatchExactly
+        )
+        if items:
+            self.file_list_widget.setCurrentItem(items[0])
+        self.file_list_widget.blockSignals(False)
+        if self.open_after_scan:
+            self.open_after_scan = False
+            self.filename = None
+            self.open_next_image()
+
+    def on_project_index_refreshed(self, project_index):
+        if project_index is self.project_index:
+            self.update_file_label_filter()
+
+    def update_file_label_filter(self):
+        """Fill the label filter with the labels of the index and their
+        number of images, keeping the selected label"""
+        label = self.file_label_filter.currentData()
+        label_counts = self.project_index.get_label_counts()
+        if label is not None:
+            label_counts.setdefault(label, (0, 0))
+        self.file_label_filter.blockSignals(True)
+        self.file_label_filter.clear()
+        self.file_label_filter.addItem(self.tr("All Labels"), None)
+        for label_name, (num_images, _) in sorted(label_counts.items()):
+            self.file_label_filter.addItem(
+                f"{label_name} ({num_images})", label_name
+            )
+        if label is not None:
+            self.file_label_filter.setCurrentIndex(
+                self.file_label_filter.findData(label)
+            )
+        self.file_label_filter.blockSignals(False)
+
+    def fill_file_list(self, pattern=None):
+        """Fill the file list with the images of the index, filtered by
+        the status and label filters and by a pattern of their paths"""
         self.file_list_widget.clear()
-        for filename in self.scan_all_images(dirpath):
-            if pattern and pattern not in filename:
-                continue
-            label_file = osp.splitext(filename)[0] + ".json"
-            if self.output_dir:
-                label_file_without_path = osp.basename(label_file)
-                label_file = osp.join(self.output_dir, label_file_without_path)
+        images = self.project_index.get_images(
+            status=self.file_status_filter.currentData(),
+            pattern=pattern,
+            label=self.file_label_filter.currentData(),
+        )
+        for filename, has_label_file in images:
             item = QtWidgets.QListWidgetItem(filename)
             item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-            if QtCore.QFile.exists(label_file) and LabelFile.is_label_file(
-                label_file
-            ):
+            if has_label_file:
                 item.setCheckState(Qt.Checked)
             else:
                 item.setCheckState(Qt.Unchecked)
             self.file_list_widget.addItem(item)
-        self.open_next_image(load=load)
-
-    def scan_all_images(self, folder_path):
-        extensions = [
-            f".{fmt.data().decode().lower()}"
-            for fmt in QtGui.QImageReader.supportedImageFormats()
-        ]
-
-        images = []
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                if file.lower().endswith(tuple(extensions)):
-                    relative_path = osp.join(root, file)
-                    images.append(relative_path)
-        images = natsort.os_sorted(images)
-        return images
 
     def toggle_auto_labeling_widget(self):
         """Toggle auto labeling widget visibility."""
@@ -0,0 +1,423 @@
+"""Index of the images and label files of a project folder.
+
+The index is a SQLite database, one per image folder and output folder,
+in ~/anylabeling_data/project_index. It records the images of the folder,
+whether they have a label file, their dimensions and their number of
+shapes per label. The image list is then built and filtered with queries
+instead of checking or reading every label file. Label files are checked
+by modification time in the background, and only new or modified label
+files are read again.
+"""
+import collections
+import hashlib
+import logging
+import os
+import os.path as osp
+import sqlite3
+import threading
+
+import natsort
+from PyQt5 import QtGui
+
+from .label_file import LabelFile
+
+DEFAULT_PROJECT_INDEX_DIR = osp.join(
+    osp.expanduser("~"), "anylabeling_data", "project_index"
+)
+
+STATUS_ALL = "all"
+STATUS_LABELED = "labeled"
+STATUS_UNLABELED = "unlabeled"
+
+# Label files read per transaction when refreshing the index
+REFRESH_BATCH_SIZE = 256
+
+# indexed_mtime_ns of labels saved from the GUI, before their label file
+# is written
+SAVED_MTIME_NS = 0
+
+# Default of the previous_mtime_ns argument, for unconditional updates
+_ANY_MTIME_NS = object()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    has_label_file INTEGER NOT NULL DEFAULT 0,
+    indexed_mtime_ns INTEGER,
+    image_height INTEGER,
+    image_width INTEGER,
+    num_shapes INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS images_position ON images (position);
+CREATE TABLE IF NOT EXISTS labels (
+    path TEXT NOT NULL REFERENCES images (path) ON DELETE CASCADE,
+    label TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (path, label)
+);
+CREATE INDEX IF NOT EXISTS labels_label ON labels (label);
+"""
+
+
+def get_image_extensions():
+    """Get the (lowercase) extensions of the image formats Qt can read"""
+    return [
+        f".{fmt.data().decode().lower()}"
+        for fmt in QtGui.QImageReader.supportedImageFormats()
+    ]
+
+
+def get_label_file(image_path, output_dir=None):
+    """Get the label file of an image: next to the image, or in
+    output_dir if set"""
+    label_file = osp.splitext(image_path)[0] + LabelFile.suffix
+    if output_dir:
+        label_file = osp.join(output_dir, osp.basename(label_file))
+    return label_file
+
+
+def list_images(root_dir, extensions, output_dir=None):
+    """List the images of a folder and its subfolders with the given
+    (lowercase) extensions, in natural order. Label files are looked up
+    in directory listings, without reading them.
+
+    Returns:
+        list: (image path, path relative to the folder, has label file)
+    """
+    if output_dir and osp.isdir(output_dir):
+        output_file_names = set(os.listdir(output_dir))
+    else:
+        output_file_names = set()
+
+    entries = []
+    for root, _, files in os.walk(root_dir):
+        relative_root = osp.relpath(root, root_dir)
+        if relative_root == os.curdir:
+            relative_root = ""
+        label_file_names = output_file_names if output_dir else set(files)
+        for file in files:
+            if not file.lower().endswith(tuple(extensions)):
+                continue
+            label_file_name = get_label_file(file)
+            entries.append(
+                (
+                    osp.join(root, file),
+                    osp.join(relative_root, file),
+                    label_file_name in label_file_names,
+                )
+            )
+    return natsort.os_sorted(entries, key=lambda entry: entry[0])
+
+
+class ProjectIndex:
+    """Index of the images of a folder and of their label files.
+
+    Image paths are stored relative to the folder. `indexed_mtime_ns` is
+    the modification time of the label file whose content is indexed,
+    NULL if no content is indexed. All methods are thread-safe.
+    """
+
+    def __init__(
+        self, root_dir, output_dir=None, index_dir=DEFAULT_PROJECT_INDEX_DIR
+    ):
+        """Open the index of a folder
+
+        Args:
+            root_dir (str): Folder of the images.
+            output_dir (str, optional): Folder of the label files. If None,
+                label files are next to the images.
+            index_dir (str, optional): Folder of the index databases. If
+                None, or if the database cannot be opened, the index is
+                kept in memory.
+        """
+        self.root_dir = root_dir
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+        self._closed = False
+        # Label files saved from the GUI -> image path
+        self._saved_label_files = {}
+        self._connection = None
+        if index_dir is not None:
+            key = "\n".join(
+                osp.abspath(folder) if folder else ""
+                for folder in [root_dir, output_dir]
+            )
+            db_file = osp.join(
+                index_dir,
+                f"{osp.basename(osp.abspath(root_dir))}-"
+                f"{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}.db",
+            )
+            try:
+                os.makedirs(index_dir, exist_ok=True)
+                self._connection = self._connect(db_file)
+            except (OSError, sqlite3.Error) as e:
+                logging.warning("Could not open project index: %s", e)
+        if self._connection is None:
+            self._connection = self._connect(":memory:")
+
+    @staticmethod
+    def _connect(db_file):
+        connection = sqlite3.connect(db_file, check_same_thread=False)
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.executescript(SCHEMA)
+        connection.commit()
+        return connection
+
+    def close(self):
+        """Close the index, stopping a running refresh"""
+        with self._lock:
+            self._closed = True
+            self._connection.close()
+
+    def get_label_file(self, image_path):
+        """Get the label file of an image, like the GUI"""
+        return get_label_file(image_path, self.output_dir)
+
+    def _get_key(self, image_path):
+        """Get the path of an image relative to the folder,
+        or None if it is not in the folder"""
+        path = osp.relpath(osp.abspath(image_path), osp.abspath(self.root_dir))
+        return None if path.startswith(os.pardir) else path
+
+    def scan(self, extensions):
+        """Scan the folder for images with the given (lowercase)
+        extensions and update the images of the index. Returns True if
+        the images of the index changed."""
+        entries = list_images(self.root_dir, extensions, self.output_dir)
+        rows = [
+            (path, position, has_label_file)
+            for position, (_, path, has_label_file) in enumerate(entries)
+        ]
+
+        with self._lock:
+            if self._closed:
+                return False
+            indexed_rows = {
+                path: (position, has_label_file)
+                for path, position, has_label_file in self._connection.execute(
+                    "SELECT path, position, has_label_file FROM images"
+                )
+            }
+            # Label files may have been saved or deleted from the GUI
+            # since the folder was listed: they are checked again
+            saved_paths = set(self._saved_label_files.values())
+            for i, (path, position, has_label_file) in enumerate(rows):
+                indexed_row = indexed_rows.get(path)
+                if indexed_row is None or indexed_row[1] == has_label_file:
+                    continue
+                label_file = self.get_label_file(osp.join(self.root_dir, path))
+                has_label_file = path in saved_paths or osp.exists(label_file)
+                rows[i] = (path, position, has_label_file)
+            paths = {path for path, _, _ in rows}
+            removed_paths = [
+                path for path in indexed_rows if path not in paths
+            ]
+            changed_rows = [
+                row for row in rows if indexed_rows.get(row[0]) != row[1:]
+            ]
+            with self._connection:
+                self._connection.executemany(
+                    "DELETE FROM images WHERE path = ?",
+                    [(path,) for path in removed_paths],
+                )
+                self._connection.executemany(
+                    "INSERT INTO images (path, position, has_label_file) "
+                    "VALUES (?, ?, ?) ON CONFLICT (path) DO UPDATE SET "
+                    "position = excluded.position, "
+                    "has_label_file = excluded.has_label_file",
+                    changed_rows,
+                )
+                # Forget the content of removed label files
+                self._clear_labels(
+                    [
+                        path
+                        for path, _, has_label_file in changed_rows
+                        if not has_label_file
+                        and indexed_rows.get(path, (None, False))[1]
+                    ]
+                )
+        return bool(removed_paths or changed_rows)
+
+    def _clear_labels(self, paths):
+        self._connection.executemany(
+            "UPDATE images SET indexed_mtime_ns = NULL, num_shapes = 0, "
+            "image_height = NULL, image_width = NULL WHERE path = ?",
+            [(path,) for path in paths],
+        )
+        self._connection.executemany(
+            "DELETE FROM labels WHERE path = ?", [(path,) for path in paths]
+        )
+
+    def _set_labels(
+        self,
+        path,
+        labels,
+        image_height,
+        image_width,
+        mtime_ns,
+        previous_mtime_ns=_ANY_MTIME_NS,
+    ):
+        """Index the labels of an image. If previous_mtime_ns is given,
+        the image is only updated if its indexed_mtime_ns is still that
+        value. Returns True if the image is updated."""
+        query = (
+            "UPDATE images SET has_label_file = 1, indexed_mtime_ns = ?, "
+            "num_shapes = ?, image_height = ?, image_width = ? "
+            "WHERE path = ?"
+        )
+        parameters = [mtime_ns, len(labels), image_height, image_width, path]
+        if previous_mtime_ns is not _ANY_MTIME_NS:
+            query += " AND indexed_mtime_ns IS ?"
+            parameters.append(previous_mtime_ns)
+        if not self._connection.execute(query, parameters).rowcount:
+            return False
+        self._connection.execute("DELETE FROM labels WHERE path = ?", (path,))
+        self._connection.executemany(
+            "INSERT INTO labels (path, label, count) VALUES (?, ?, ?)",
+            [
+                (path, label, count)
+                for label, count in collections.Counter(labels).items()
+            ],
+        )
+        return True
+
+    def refresh(self):
+        """Read the label files which are new or were modified since they
+        were indexed. Runs until done or until the index is closed."""
+        with self._lock:
+            if self._closed:
+                return
+            rows = self._connection.execute(
+                "SELECT path, indexed_mtime_ns FROM images "
+                "WHERE has_label_file = 1 ORDER BY position"
+            ).fetchall()
+
+        for start in range(0, len(rows), REFRESH_BATCH_SIZE):
+            updates = []
+            for path, indexed_mtime_ns in rows[
+                start : start + REFRESH_BATCH_SIZE
+            ]:
+                label_file = self.get_label_file(osp.join(self.root_dir, path))
+                try:
+                    mtime_ns = os.stat(label_file).st_mtime_ns
+                    if mtime_ns == indexed_mtime_ns:
+                        continue
+                    data = LabelFile(label_file)
+                except Exception as e:  # noqa
+                    logging.warning("Could not index %s: %s", label_file, e)
+                    continue
+                labels = [shape["label"] for shape in data.shapes]
+                updates.append(
+                    (
+                        path,
+                        labels,
+                        data.image_height,
+                        data.image_width,
+                        mtime_ns,
+                        indexed_mtime_ns,
+                    )
+                )
+
+            with self._lock:
+                if self._closed:
+                    return
+                # Labels indexed meanwhile, e.g. saved from the GUI, are
+                # more recent: rows changed since they were read are kept.
+                # Labels saved again before their label file is written
+                # keep indexed_mtime_ns, so they are checked separately.
+                saved_paths = set(self._saved_label_files.values())
+                with self._connection:
+                    for update in updates:
+                        if update[0] not in saved_paths:
+                            self._set_labels(*update)
+
+    def set_labels(self, image_path, label_file, shapes, height, width):
+        """Index the labels of an image saved from the GUI. Its label
+        file is expected to be written afterwards, then
+        `set_label_file_saved()` to be called."""
+        path = self._get_key(image_path)
+        if path is None or osp.normpath(label_file) != osp.normpath(
+            self.get_label_file(image_path)
+        ):
+            return
+        with self._lock:
+            with self._connection:
+                self._set_labels(
+                    path,
+                    [shape["label"] for shape in shapes],
+                    height,
+                    width,
+                    SAVED_MTIME_NS,
+                )
+            self._saved_label_files[osp.normpath(label_file)] = path
+
+    def set_label_file_saved(self, label_file):
+        """Record the modification time of a label file written with
+        the labels of `set_labels()`"""
+        with self._lock:
+            path = self._saved_label_files.pop(osp.normpath(label_file), None)
+            if path is None:
+                return
+            try:
+                mtime_ns = os.stat(label_file).st_mtime_ns
+            except OSError:
+                return
+            with self._connection:
+                self._connection.execute(
+                    "UPDATE images SET indexed_mtime_ns = ? "
+                    "WHERE path = ? AND indexed_mtime_ns = ?",
+                    (mtime_ns, path, SAVED_MTIME_NS),
+                )
+
+    def remove_labels(self, image_path):
+        """Record that the label file of an image was deleted"""
+        path = self._get_key(image_path)
+        if path is None:
+            return
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "UPDATE images SET has_label_file = 0 WHERE path = ?",
+                    (path,),
+                )
+                self._clear_labels([path])
+
+    def get_images(self, status=STATUS_ALL, pattern=None, label=None):
+        """Get (image path, has label file) of the images, in folder
+        order, filtered by label file status, by a pattern contained in
+        the path and by a label of their shapes"""
+        query = "SELECT path, has_label_file FROM images"
+        conditions, parameters = [], []
+        if status == STATUS_LABELED:
+            conditions.append("has_label_file = 1")
+        elif status == STATUS_UNLABELED:
+            conditions.append("has_label_file = 0")
+        if label is not None:
+            conditions.append(
+                "path IN (SELECT path FROM labels WHERE label = ?)"
+            )
+            parameters.append(label)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY position"
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        images = [
+            (osp.join(self.root_dir, path), bool(has_label_file))
+            for path, has_label_file in rows
+        ]
+        if pattern:
+            images = [image for image in images if pattern in image[0]]
+        return images
+
+    def get_label_counts(self):
+        """Get label -> (number of images, number of shapes)
+        of the indexed label files"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT label, COUNT(*), SUM(count) FROM labels "
+                "GROUP BY label ORDER BY label"
+            ).fetchall()
+        return {label: (images, shapes) for label, images, shapes in rows}
@@ -3,13 +3,16 @@
 from ._io import lblsave
 from .image import (
     apply_exif_orientation,
+    get_exif_orientation,
     img_arr_to_b64,
     img_b64_to_arr,
     img_data_to_arr,
     img_data_to_pil,
+    img_data_to_size,
     img_data_to_png_data,
     img_pil_to_data,
 )
+from .image_cache import rgb_array_to_qimage
 from .qt import (
     Struct,
     add_actions,
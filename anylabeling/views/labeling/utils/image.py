@@ -14,6 +14,13 @@ def img_data_to_pil(img_data):
     return img_pil
 
 
+def img_data_to_size(img_data):
+    """Get the (width, height) of image data from its header,
+    without decoding the image"""
+    with PIL.Image.open(io.BytesIO(img_data)) as img_pil:
+        return img_pil.size
+
+
 def img_data_to_arr(img_data):
     img_pil = img_data_to_pil(img_data)
     img_arr = np.array(img_pil)
@@ -56,6 +63,20 @@ def img_data_to_png_data(img_data):
             return f.read()
 
 
+def get_exif_orientation(image):
+    """Get the EXIF orientation of an image opened with PIL, or None.
+    Only the header is read: the image is not decoded."""
+    if hasattr(image, "tag_v2"):
+        # TIFF tags are read on open
+        return image.tag_v2.get(0x0112)
+    exif_data = image.info.get("exif")
+    if not exif_data:
+        return None
+    exif = PIL.Image.Exif()
+    exif.load(exif_data)
+    return exif.get(0x0112)
+
+
 def apply_exif_orientation(image):
     try:
         exif = image._getexif()
@@ -0,0 +1,95 @@
+"""Cache of decoded images, shared by the canvas and the models."""
+import hashlib
+import io
+import logging
+import os
+import threading
+
+import numpy as np
+import PIL.Image
+from PyQt5 import QtGui
+
+from anylabeling.services.auto_labeling.lru_cache import LRUCache
+from .image import apply_exif_orientation
+
+DEFAULT_IMAGE_CACHE_MEMORY_MB = 512
+
+
+def decode_image(image_file_or_data):
+    """Decode an image file or image bytes into a read-only 8-bit RGB
+    array, with the EXIF orientation applied"""
+    if isinstance(image_file_or_data, bytes):
+        image_file_or_data = io.BytesIO(image_file_or_data)
+    with PIL.Image.open(image_file_or_data) as image_pil:
+        image_pil = apply_exif_orientation(image_pil)
+        if image_pil.mode in ("I", "I;16", "I;16B", "I;16L", "F"):
+            # Stretch 16-bit and float images to 8-bit, like the models do
+            image = np.asarray(image_pil, dtype=np.float64)
+            image_range = max(image.max() - image.min(), 1e-12)
+            image = (image - image.min()) * (255 / image_range)
+            image_pil = PIL.Image.fromarray(image.astype(np.uint8))
+        image = np.ascontiguousarray(image_pil.convert("RGB"))
+    image.flags.writeable = False
+    return image
+
+
+def rgb_array_to_qimage(image):
+    """Get a QImage viewing the pixels of an RGB array, without copy.
+    The array must outlive the QImage and its copies."""
+    height, width = image.shape[:2]
+    return QtGui.QImage(
+        image.data,
+        width,
+        height,
+        image.strides[0],
+        QtGui.QImage.Format_RGB888,
+    )
+
+
+class ImageCache:
+    """LRU cache of decoded RGB images, so that an image is decoded once
+    for display and for all models. Files are keyed by path and
+    modification time, so they are decoded again when they change.
+    Image bytes are keyed by their hash."""
+
+    def __init__(self, max_bytes):
+        self.cache = LRUCache(maxsize=None, max_bytes=max_bytes)
+
+    def get(self, filename):
+        """Get the decoded image of a file,
+        or None if it cannot be decoded"""
+        try:
+            stat = os.stat(filename)
+            key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+            return self.cache.get_or_compute(key, decode_image, filename)
+        except Exception as e:  # noqa
+            logging.warning("Could not decode image %s: %s", filename, e)
+            return None
+
+    def get_from_data(self, image_data):
+        """Get the decoded image of image bytes, e.g. embedded in
+        a label file, or None if they cannot be decoded"""
+        try:
+            key = hashlib.sha1(image_data).digest()
+            return self.cache.get_or_compute(key, decode_image, image_data)
+        except Exception as e:  # noqa
+            logging.warning("Could not decode image data: %s", e)
+            return None
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache():
+    """Get the image cache of the application"""
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            from anylabeling.config import get_config
+
+            memory_mb = get_config().get(
+                "image_cache_memory_mb", DEFAULT_IMAGE_CACHE_MEMORY_MB
+            )
+            _image_cache = ImageCache(max_bytes=memory_mb * 1024 * 1024)
+        return _image_cache
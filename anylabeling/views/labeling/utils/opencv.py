@@ -9,9 +9,12 @@ from PyQt5.QtGui import QImage
 
 def qt_img_to_rgb_cv_img(qt_img, img_path=None):
     """
-    Convert 8bit/16bit RGB image or 8bit/16bit Gray image to 8bit RGB image
+    Convert 8bit/16bit RGB image or 8bit/16bit Gray image to 8bit RGB image.
+    qt_img can also be an RGB or Gray numpy array, e.g. in headless mode.
     """
-    if img_path is not None and os.path.exists(img_path):
+    if isinstance(qt_img, np.ndarray):
+        cv_image = qt_img
+    elif img_path is not None and os.path.exists(img_path):
         # Load Image From Path Directly
         cv_image = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), -1)
         cv_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
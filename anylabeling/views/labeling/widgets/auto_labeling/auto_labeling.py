@@ -188,8 +188,12 @@ class AutoLabelingWidget(QWidget):
     def run_prediction(self):
         """Run prediction"""
         if self.parent.filename is not None:
+            # Models share the decoded pixels of the canvas image
+            image = self.parent.image_array
+            if image is None:
+                image = self.parent.image
             self.model_manager.predict_shapes_threading(
-                self.parent.image, self.parent.filename
+                image, self.parent.filename
             )
 
     def unload_and_hide(self):
@@ -293,6 +297,10 @@ class AutoLabelingWidget(QWidget):
     def on_new_marks(self, marks):
         """Handle new marks"""
         self.model_manager.set_auto_labeling_marks(marks)
+        # Segmenting everything ignores marks, it only runs from the
+        # Run button
+        if self.output_select_combobox.currentData() == "everything":
+            return
         self.run_prediction()
 
     def on_open(self):
@@ -1,8 +1,9 @@
 """This module defines brightness/contrast dialog"""
 
+import numpy as np
 import PIL.Image
 import PIL.ImageEnhance
-from PyQt5 import QtGui, QtWidgets
+from PyQt5 import QtWidgets
 from PyQt5.QtCore import Qt
 
 from .. import utils
@@ -37,9 +38,10 @@ class BrightnessContrastDialog(QtWidgets.QDialog):
         img = PIL.ImageEnhance.Brightness(img).enhance(brightness)
         img = PIL.ImageEnhance.Contrast(img).enhance(contrast)
 
-        img_data = utils.img_pil_to_data(img)
-        qimage = QtGui.QImage.fromData(img_data)
-        self.callback(qimage)
+        # The QImage views the pixels of img_array, which outlives it:
+        # the callback copies the image into a pixmap
+        img_array = np.asarray(img.convert("RGB"))
+        self.callback(utils.rgb_array_to_qimage(img_array))
 
     def _create_slider(self):
         """Create brightness/contrast slider"""
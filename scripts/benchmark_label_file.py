@@ -0,0 +1,100 @@
+"""Benchmark reading and writing label files.
+
+Write and read a synthetic label file of dense polygons (10k vertices in
+total by default) with each installed JSON codec of
+anylabeling.views.labeling.label_file, indented and compact, and report
+times and file sizes.
+
+Usage, from the repository root:
+    PYTHONPATH=. python scripts/benchmark_label_file.py [--runs 20]
+"""
+import argparse
+import os
+import os.path as osp
+import tempfile
+import time
+
+import numpy as np
+
+from anylabeling.views.labeling import label_file
+from anylabeling.views.labeling.label_file import LabelFile
+
+IMAGE_SIZE = (1080, 1920)  # height, width
+
+
+def make_shapes(num_shapes, num_vertices, rng):
+    """Make polygons like the dense ones of Segment Anything"""
+    shapes = []
+    for i in range(num_shapes):
+        center = rng.uniform(200, 800, 2)
+        angles = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+        radius = rng.uniform(50, 150) + rng.normal(0, 2, num_vertices)
+        points = center + radius[:, None] * np.stack(
+            [np.cos(angles), np.sin(angles)], axis=1
+        )
+        shapes.append(
+            {
+                "label": f"object_{i}",
+                "text": "",
+                "points": [(float(x), float(y)) for x, y in points],
+                "group_id": None,
+                "shape_type": "polygon",
+                "flags": {},
+            }
+        )
+    return shapes
+
+
+def benchmark(filename, shapes, compact, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        LabelFile().save(
+            filename=filename,
+            shapes=shapes,
+            image_path="image.jpg",
+            image_height=IMAGE_SIZE[0],
+            image_width=IMAGE_SIZE[1],
+            compact=compact,
+        )
+    write_ms = (time.perf_counter() - start) / runs * 1000
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        LabelFile(filename)
+    read_ms = (time.perf_counter() - start) / runs * 1000
+    return write_ms, read_ms, osp.getsize(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--shapes", type=int, default=10)
+    parser.add_argument("--vertices", type=int, default=1000)
+    args = parser.parse_args()
+
+    shapes = make_shapes(args.shapes, args.vertices, np.random.default_rng(0))
+    codecs = [label_file.StdlibJSONCodec]
+    if label_file.orjson is not None:
+        codecs.append(label_file.OrjsonCodec)
+    else:
+        print("orjson is not installed, only the stdlib codec is measured")
+
+    print(f"{args.shapes} polygons of {args.vertices} vertices")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = osp.join(temp_dir, "image.json")
+        for codec in codecs:
+            LabelFile.codec = codec
+            for compact in [False, True]:
+                write_ms, read_ms, size = benchmark(
+                    filename, shapes, compact, args.runs
+                )
+                print(
+                    f"{codec.name:>6} {'compact' if compact else 'indented':>8}"
+                    f": write {write_ms:7.2f} ms, read {read_ms:7.2f} ms, "
+                    f"{size / 1024:7.1f} KiB"
+                )
+            os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Benchmark YOLOv5 / YOLOv8 output decoding.
+
+Compare the former per-row Python loops with the vectorized decoding of
+anylabeling.services.auto_labeling.yolo_utils on synthetic network outputs,
+and check that both give the same boxes.
+
+Usage, from the repository root:
+    PYTHONPATH=. python scripts/benchmark_yolo_postprocess.py [--runs 20]
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from anylabeling.services.auto_labeling.yolo_utils import (
+    decode_yolov5_outputs,
+    decode_yolov8_outputs,
+    get_output_boxes,
+    non_max_suppression,
+    scale_boxes,
+)
+
+INPUT_SIZE = 640
+IMAGE_SIZE = (1080, 1920)  # height, width
+NUM_CLASSES = 80
+CONFIDENCE_THRESHOLD = 0.45
+SCORE_THRESHOLD = 0.5
+NMS_THRESHOLD = 0.45
+CLASSES = [f"class_{i}" for i in range(NUM_CLASSES)]
+
+
+def make_outputs(num_rows, num_extra, rng):
+    """Make a synthetic output with a few hundred confident rows"""
+    outputs = np.empty((num_rows, 4 + num_extra), dtype=np.float32)
+    outputs[:, :2] = rng.uniform(0, INPUT_SIZE, (num_rows, 2))
+    outputs[:, 2:4] = rng.uniform(4, INPUT_SIZE / 4, (num_rows, 2))
+    outputs[:, 4:] = rng.uniform(0, 0.3, (num_rows, num_extra))
+    confident = rng.choice(num_rows, 300, replace=False)
+    outputs[confident, 4:] = rng.uniform(0.3, 1.0, (300, num_extra))
+    return outputs
+
+
+def legacy_nms(boxes, confidences, class_ids):
+    indices = cv2.dnn.NMSBoxes(
+        boxes, confidences, CONFIDENCE_THRESHOLD, NMS_THRESHOLD
+    )
+    output_boxes = []
+    for i in indices:
+        left, top, width, height = boxes[i]
+        output_boxes.append(
+            {
+                "x1": left,
+                "y1": top,
+                "x2": left + width,
+                "y2": top + height,
+                "label": CLASSES[class_ids[i]],
+                "score": confidences[i],
+            }
+        )
+    return output_boxes
+
+
+def legacy_yolov5(outputs, x_factor, y_factor):
+    class_ids, confidences, boxes = [], [], []
+    for r in range(outputs.shape[0]):
+        row = outputs[r]
+        confidence = row[4]
+        if confidence >= CONFIDENCE_THRESHOLD:
+            classes_scores = row[5:]
+            class_id = np.argmax(classes_scores)
+            if classes_scores[class_id] > SCORE_THRESHOLD:
+                confidences.append(confidence)
+                class_ids.append(class_id)
+                cx, cy, w, h = row[0], row[1], row[2], row[3]
+                left = int((cx - w / 2) * x_factor)
+                top = int((cy - h / 2) * y_factor)
+                width = int(w * x_factor)
+                height = int(h * y_factor)
+                boxes.append(np.array([left, top, width, height]))
+    return legacy_nms(boxes, confidences, class_ids)
+
+
+def legacy_yolov8(outputs, x_factor, y_factor):
+    class_ids, confidences, boxes = [], [], []
+    for r in range(outputs.shape[0]):
+        row = outputs[r]
+        # Column vector, as OpenCV 4 reads 1D arrays (OpenCV 5 reads rows)
+        classes_scores = row[4:].reshape(-1, 1)
+        _, confidence, _, (_, class_id) = cv2.minMaxLoc(classes_scores)
+        if confidence >= CONFIDENCE_THRESHOLD:
+            confidences.append(confidence)
+            class_ids.append(class_id)
+            cx, cy, w, h = row[0], row[1], row[2], row[3]
+            left = int((cx - w / 2) * x_factor)
+            top = int((cy - h / 2) * y_factor)
+            width = int(w * x_factor)
+            height = int(h * y_factor)
+            boxes.append(np.array([left, top, width, height]))
+    return legacy_nms(boxes, confidences, class_ids)
+
+
+def vectorized(boxes, confidences, class_ids, x_factor, y_factor):
+    boxes = scale_boxes(boxes, x_factor, y_factor)
+    indices = non_max_suppression(
+        boxes,
+        confidences,
+        class_ids,
+        CONFIDENCE_THRESHOLD,
+        NMS_THRESHOLD,
+    )
+    return get_output_boxes(boxes, confidences, class_ids, indices, CLASSES)
+
+
+def vectorized_yolov5(outputs, x_factor, y_factor):
+    return vectorized(
+        *decode_yolov5_outputs(outputs, CONFIDENCE_THRESHOLD, SCORE_THRESHOLD),
+        x_factor,
+        y_factor,
+    )
+
+
+def vectorized_yolov8(outputs, x_factor, y_factor):
+    return vectorized(
+        *decode_yolov8_outputs(outputs, CONFIDENCE_THRESHOLD),
+        x_factor,
+        y_factor,
+    )
+
+
+def same_boxes(boxes_a, boxes_b):
+    keys = ["x1", "y1", "x2", "y2", "label"]
+    return len(boxes_a) == len(boxes_b) and all(
+        [a[key] for key in keys] == [b[key] for key in keys]
+        and np.isclose(a["score"], b["score"])
+        for a, b in zip(boxes_a, boxes_b)
+    )
+
+
+def benchmark(func, outputs, runs):
+    x_factor = IMAGE_SIZE[1] / INPUT_SIZE
+    y_factor = IMAGE_SIZE[0] / INPUT_SIZE
+    start = time.perf_counter()
+    for _ in range(runs):
+        result = func(outputs, x_factor, y_factor)
+    return (time.perf_counter() - start) / runs * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    cases = [
+        ("YOLOv5", 25200, 1 + NUM_CLASSES, legacy_yolov5, vectorized_yolov5),
+        ("YOLOv8", 8400, NUM_CLASSES, legacy_yolov8, vectorized_yolov8),
+    ]
+    for name, num_rows, num_extra, legacy, new in cases:
+        outputs = make_outputs(num_rows, num_extra, rng)
+        legacy_ms, legacy_boxes = benchmark(legacy, outputs, args.runs)
+        new_ms, new_boxes = benchmark(new, outputs, args.runs)
+        print(
+            f"{name}: loop {legacy_ms:.2f} ms, vectorized {new_ms:.2f} ms "
+            f"({legacy_ms / new_ms:.1f}x), {len(new_boxes)} boxes, "
+            f"identical: {same_boxes(legacy_boxes, new_boxes)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -87,6 +87,10 @@ setup(
     author_email="vietanh.dev@gmail.com",
     url="https://github.com/vietanhdev/anylabeling",
     install_requires=get_install_requires(),
+    extras_require={
+        # Streaming parser for large label files with embedded images
+        "streaming": ["ijson>=3.2"],
+    },
     license="GPLv3",
     keywords="Image Annotation, Machine Learning, Deep Learning",
     classifiers=[
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+
+from anylabeling.services.auto_labeling.embedding_store import (
+    META_FILE,
+    EmbeddingStore,
+)
+
+
+def make_image(tmp_path, name="image.jpg", content=b"image"):
+    filename = tmp_path / name
+    filename.write_bytes(content)
+    return str(filename)
+
+
+def test_put_replaces_stale_entry(tmp_path):
+    store = EmbeddingStore("model", cache_dir=str(tmp_path / "store"))
+    filename = make_image(tmp_path)
+    store.put(filename, {"image_embedding": np.ones(4, dtype=np.float32)})
+
+    # Entry left without its meta file by a partly failed eviction
+    path = store._entry_path(store.get_image_hash(filename))
+    os.remove(os.path.join(path, META_FILE))
+    assert not store.find(filename)
+
+    store.put(filename, {"image_embedding": np.ones(4, dtype=np.float32)})
+    assert store.find(filename)
+    assert store.get(filename)["image_embedding"].tolist() == [1, 1, 1, 1]
+
+
+def test_put_keeps_new_entry_over_quota(tmp_path):
+    store = EmbeddingStore(
+        "model", cache_dir=str(tmp_path / "store"), max_size_mb=0.001
+    )
+    old_filename = make_image(tmp_path, "old.jpg", b"old")
+    new_filename = make_image(tmp_path, "new.jpg", b"new")
+    embedding = {"image_embedding": np.zeros(1024, dtype=np.float32)}
+    store.put(old_filename, embedding)
+    store.put(new_filename, embedding)
+    assert not store.find(old_filename)
+    assert store.find(new_filename)
@@ -0,0 +1,43 @@
+import io
+
+import numpy as np
+import PIL.Image
+import pytest
+
+from anylabeling.views.labeling import label_file
+from anylabeling.views.labeling.label_file import LabelFile
+
+ijson = pytest.importorskip("ijson")
+
+
+class ChunkedFile(io.BytesIO):
+    """File read in small chunks, to split tokens across reads"""
+
+    def read(self, size=-1):
+        return super().read(min(size, 3) if size > 0 else size)
+
+
+def test_streaming_skips_embedded_image(tmp_path, monkeypatch):
+    image = io.BytesIO()
+    PIL.Image.fromarray(np.zeros((10, 20, 3), "uint8")).save(image, "PNG")
+    filename = str(tmp_path / "image.json")
+    LabelFile().save(
+        filename=filename,
+        shapes=[{"label": 'a "b"', "points": [[1, 2]], "shape_type": "point"}],
+        image_path="image.png",
+        image_data=image.getvalue(),
+        other_data={"note": "imageData"},
+    )
+
+    with open(filename, "rb") as f:
+        reader = label_file._SkipImageDataReader(ChunkedFile(f.read()))
+    data = dict(ijson.kvitems(reader, "", use_float=True))
+    assert data["imageData"] is True
+    assert data["shapes"][0]["label"] == 'a "b"'
+    assert data["note"] == "imageData"
+
+    # The embedded image is read when used
+    monkeypatch.setattr(label_file, "STREAMING_MIN_FILE_SIZE", 0)
+    labels = LabelFile(filename)
+    assert labels.shapes[0]["points"] == [[1, 2]]
+    assert labels.image_data == image.getvalue()
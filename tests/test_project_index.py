@@ -0,0 +1,83 @@
+import os
+import os.path as osp
+
+from anylabeling.views.labeling import project_index
+from anylabeling.views.labeling.label_file import LabelFile
+from anylabeling.views.labeling.project_index import ProjectIndex
+
+
+def save_label_file(filename, labels):
+    LabelFile().save(
+        filename=filename,
+        shapes=[
+            {"label": label, "points": [[0, 0]], "shape_type": "point"}
+            for label in labels
+        ],
+        image_path="image.jpg",
+        image_height=10,
+        image_width=20,
+    )
+
+
+def test_refresh_keeps_labels_saved_meanwhile(tmp_path, monkeypatch):
+    image_file = str(tmp_path / "image.jpg")
+    label_file = str(tmp_path / "image.json")
+    (tmp_path / "image.jpg").write_bytes(b"")
+    save_label_file(label_file, ["cat"])
+
+    index = ProjectIndex(str(tmp_path), index_dir=None)
+    index.scan([".jpg"])
+
+    class SavingLabelFile(LabelFile):
+        """Label file read by the refresh, while the GUI saves it"""
+
+        def __init__(self, filename):
+            super().__init__(filename)
+            index.set_labels(
+                image_file, label_file, [{"label": "dog"}], 10, 20
+            )
+            save_label_file(label_file, ["dog"])
+            index.set_label_file_saved(label_file)
+
+    monkeypatch.setattr(project_index, "LabelFile", SavingLabelFile)
+    index.refresh()
+    assert index.get_label_counts() == {"dog": (1, 1)}
+
+    # The saved label file is up to date in the index
+    monkeypatch.setattr(project_index, "LabelFile", LabelFile)
+    index.refresh()
+    assert index.get_label_counts() == {"dog": (1, 1)}
+
+
+def test_scan_keeps_labels_saved_meanwhile(tmp_path, monkeypatch):
+    for name in ["a", "b"]:
+        (tmp_path / f"{name}.jpg").write_bytes(b"")
+    save_label_file(str(tmp_path / "b.json"), ["cat"])
+
+    index = ProjectIndex(str(tmp_path), index_dir=None)
+    assert index.scan([".jpg"])
+    assert not index.scan([".jpg"])
+    index.refresh()
+
+    walk = os.walk
+
+    def saving_walk(top):
+        """Folder listed by the scan, then labels saved from the GUI"""
+        yield from walk(top)
+        index.set_labels(
+            str(tmp_path / "a.jpg"),
+            str(tmp_path / "a.json"),
+            [{"label": "dog"}],
+            10,
+            20,
+        )
+        index.remove_labels(str(tmp_path / "b.jpg"))
+        os.remove(tmp_path / "b.json")
+
+    monkeypatch.setattr(project_index.os, "walk", saving_walk)
+    index.scan([".jpg"])
+    assert [
+        (osp.basename(path), has_label_file)
+        for path, has_label_file in index.get_images()
+    ] == [("a.jpg", True), ("b.jpg", False)]
+    assert index.get_label_counts() == {"dog": (1, 1)}
@@ -0,0 +1,73 @@
+import threading
+import types
+
+import numpy as np
+
+from anylabeling.services.auto_labeling.lru_cache import LRUCache
+from anylabeling.services.auto_labeling.preload_scheduler import (
+    PreloadScheduler,
+)
+from anylabeling.services.auto_labeling.segment_anything import (
+    NUM_RESERVED_EMBEDDINGS,
+    SegmentAnything,
+)
+
+EMBEDDING_NBYTES = 1000
+CACHE_SIZE = 10
+
+
+def make_model():
+    """Make a model with the preloading methods of SegmentAnything
+    and a fake encoder"""
+    model = types.SimpleNamespace(
+        stop_inference=False,
+        image_embedding_cache=LRUCache(
+            maxsize=None, max_bytes=CACHE_SIZE * EMBEDDING_NBYTES
+        ),
+        encoded=[],
+    )
+
+    def encode(filename):
+        model.encoded.append(filename)
+        return np.zeros(EMBEDDING_NBYTES, dtype=np.uint8)
+
+    model.get_image_embedding = lambda filename: (
+        model.image_embedding_cache.get_or_compute(filename, encode, filename)
+    )
+    model.load_or_encode_many = lambda filenames: [
+        encode(filename) for filename in filenames
+    ]
+    for name in ["get_preloaded_size", "preload_files"]:
+        setattr(
+            model,
+            name,
+            types.MethodType(getattr(SegmentAnything, name), model),
+        )
+    return model
+
+
+def test_first_navigation_preloads_neighbours():
+    model = make_model()
+    done = threading.Event()
+    files = [f"image_{i}.jpg" for i in range(20)]
+
+    def preload_files(filenames, priorities):
+        model.preload_files(filenames, priorities)
+        if filenames[-1] == files[-1]:
+            done.set()
+
+    scheduler = PreloadScheduler(preload_files, batch_size=4)
+    try:
+        scheduler.schedule(files)
+        assert done.wait(10)
+    finally:
+        scheduler.stop()
+
+    preloaded_size = CACHE_SIZE - NUM_RESERVED_EMBEDDINGS
+    assert model.encoded == files[:preloaded_size]
+
+
+def test_cold_cache_without_current_file():
+    model = make_model()
+    model.preload_files(["a.jpg", "b.jpg", "c.jpg"], [1, 2, 3])
+    assert model.encoded == ["a.jpg", "b.jpg", "c.jpg"]